@@ -1,17 +1,42 @@
+import json
+import threading
 from pathlib import Path
 
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
+from ..search.cache import CompletionCache
+from .coalesce import SingleFlight
 from ..search.llm import LLM
 from ..search.search_engine import SearchEngine, SearchEngineCloud, SearchEngineLocal
 
 
+# The collection (Vespa streaming group) is an id sent by the client and is
+# trusted as is: any caller can read any collection whose id it knows. Bind it
+# to an authenticated caller before exposing personal libraries publicly
 class QueryRequest(BaseModel):
     query: str
     response_type: str
+    collection: str | None = None
+    # Response type generated in the background for the top hits, if any
+    prefetch: str | None = None
+
+
+class FeedRequest(BaseModel):
+    # Files inside the app's data directory
+    data_files: list[str]
+    max_data_samples: int | None = None
+
+
+class DocumentRequest(BaseModel):
+    query: str
+    doc_id: str
+    response_type: str
+    rank: int = 0
+    collection: str | None = None
 
 
 class App:
@@ -32,21 +57,35 @@ class App:
     data_dir = Path.cwd() / "data"
     data_files = ["arxiv-metadata-oai-snapshot.json"]
     dataset_size_limit = 100
+    prefetch_docs = 2
+    # Seconds clients are told to wait while the search engine is starting
+    warmup_retry_after = 10
 
     def __init__(
         self,
         search_engine: SearchEngine | None = None,
         model: LLM | None = None,
-        on_cloud: bool = False
+        on_cloud: bool = False,
+        streaming: bool = False,
+        collection: str | None = None
     ) -> None:
-        self.model = LLM() if model is None else model
-        if search_engine is None:
-            self.search_engine = (
-                SearchEngineCloud(self.endpoint, self.cert_path, self.key_path) if on_cloud
-                else SearchEngineLocal(self.data_dir, self.data_files, self.dataset_size_limit)
-            )
-        else:
-            self.search_engine = search_engine
+        self.model = (
+            LLM(cache=CompletionCache(self.data_dir / "completions.sqlite")) if model is None
+            else model
+        )
+        self.on_cloud = on_cloud
+        # A streaming engine keeps every collection (e.g. a user's own library)
+        # in its own group, queries without a collection use `collection`
+        self.streaming = streaming
+        self.collection = collection
+        self._feed_lock = threading.Lock()
+        # Without an engine, it is deployed and fed in the background once the
+        # server is up, see _start_search_engine
+        self.search_engine = search_engine
+        self._starting_engine = None
+        self._run_query_flights = SingleFlight()
+        self.state = "starting" if search_engine is None else "ready"
+        self.error = None
 
         self._app = FastAPI()
         self._app.add_middleware(
@@ -57,22 +96,221 @@ class App:
             allow_origins=["*"],
         )
 
+    def _start_search_engine(self) -> None:
+        try:
+            if self.on_cloud:
+                self.search_engine = SearchEngineCloud(
+                    self.endpoint, self.cert_path, self.key_path, streaming=self.streaming
+                )
+            else:
+                self.state = "deploying"
+                search_engine = SearchEngineLocal(
+                    self.data_dir, self.data_files, self.dataset_size_limit,
+                    streaming=self.streaming, feed=False
+                )
+                # Exposed before feeding so the probes can report its progress
+                self._starting_engine = search_engine
+                self.state = "feeding"
+                with self._feed_lock:
+                    search_engine.feed_json(
+                        self.data_dir, self.data_files, self.dataset_size_limit, self.collection
+                    )
+                self.search_engine = search_engine
+            self.state = "ready"
+        except Exception as e:
+            print(f"Could not start the search engine: {e}")
+            self.state = "failed"
+            self.error = str(e)
+
+    def feed_collection(
+        self,
+        collection: str,
+        data_files: list[str],
+        data_dir: Path | str | None = None,
+        max_data_samples: int | None = None
+    ) -> None:
+        # Feeds a user's own documents under their group, only the rows not fed
+        # to that collection yet are sent (see SearchEngineLocal.feed_json)
+        search_engine = self._ready_search_engine()
+        if not isinstance(search_engine, SearchEngineLocal):
+            raise ValueError("Only the local search engine can be fed.")
+        if not search_engine.streaming:
+            raise ValueError("Collections are only supported by streaming search engines.")
+        with self._feed_lock:
+            search_engine.feed_json(
+                self.data_dir if data_dir is None else data_dir,
+                data_files,
+                max_data_samples,
+                collection
+            )
+
+    def status(self) -> dict:
+        engine = self.search_engine or self._starting_engine
+        feed = None
+        if engine is not None and hasattr(engine, "fed_documents"):
+            feed = {
+                "fed": engine.fed_documents,
+                "failed": engine.failed_documents,
+                "total": engine.total_documents,
+            }
+        return {
+            "state": self.state,
+            "ready": self.state == "ready",
+            "feed": feed,
+            "generation": getattr(engine, "generation", None),
+            "error": self.error,
+        }
+
+    def _ready_search_engine(self) -> SearchEngine:
+        # Queries during warmup fail fast instead of waiting for the deploy
+        if self.state != "ready":
+            raise HTTPException(
+                status_code=503,
+                detail=f"The search engine is {self.state}.",
+                headers={"Retry-After": str(self.warmup_retry_after)},
+            )
+        return self.search_engine
+
     def run(self, host: str = "0.0.0.0", port: int = 8000, **kwargs) -> None:
         import uvicorn
 
-        @self._app.post("/run_query")
-        def run_query(request: QueryRequest):
-            docs = self.search_engine.search(request.query)
+        @self._app.on_event("startup")
+        async def start_search_engine():
+            # The port is bound right away, the deploy and feed run in a thread
+            if self.search_engine is None:
+                threading.Thread(target=self._start_search_engine, daemon=True).start()
+
+        @self._app.get("/healthz")
+        def healthz():
+            # Liveness: only a failed startup needs a restart
+            status = self.status()
+            return JSONResponse(status, status_code=500 if status["state"] == "failed" else 200)
+
+        @self._app.get("/readyz")
+        def readyz():
+            status = self.status()
+            if status["ready"]:
+                return status
+            return JSONResponse(
+                status,
+                status_code=503,
+                headers={"Retry-After": str(self.warmup_retry_after)},
+            )
+
+        def search(request: QueryRequest):
+            search_engine = self._ready_search_engine()
+            try:
+                docs = search_engine.search(request.query, collection=request.collection)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
             if docs.empty:
                 raise HTTPException(status_code=404, detail="No documents found.")
+            return docs
+
+        async def search_async(request: QueryRequest):
+            search_engine = self._ready_search_engine()
+            try:
+                docs = await search_engine.search_async(
+                    request.query, collection=request.collection
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            if docs.empty:
+                raise HTTPException(status_code=404, detail="No documents found.")
+            return docs
+
+        def document_response(request: DocumentRequest) -> dict:
+            search_engine = self._ready_search_engine()
+            try:
+                doc = search_engine.get_document(request.doc_id, collection=request.collection)
+                if doc is None:
+                    raise HTTPException(status_code=404, detail="Document not found.")
+                text = self.model.generate_document_response(
+                    request.query, doc, request.response_type, request.rank
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            if text is None:
+                raise HTTPException(status_code=502, detail="The LLM did not respond.")
+            return {"id": request.doc_id, "response_type": request.response_type, "text": text}
 
-            response = self.model.generate_response(
-                request.query, docs, request.response_type
+        def prefetch(request: QueryRequest, doc_ids: list[str]) -> None:
+            for rank, doc_id in enumerate(doc_ids):
+                try:
+                    document_response(DocumentRequest(
+                        query=request.query,
+                        doc_id=doc_id,
+                        response_type=request.prefetch,
+                        rank=rank,
+                        collection=request.collection
+                    ))
+                except HTTPException as e:
+                    print(f"Could not prefetch document {doc_id}: {e.detail}")
+
+        @self._app.post("/run_query")
+        async def run_query(request: QueryRequest, background_tasks: BackgroundTasks):
+            # Vespa and the LLM are awaited, so waiting requests hold no worker thread
+            async def generate():
+                docs = await search_async(request)
+                if request.prefetch is not None:
+                    # Only the request that started the search schedules the prefetch
+                    background_tasks.add_task(
+                        prefetch, request, docs["id"].iloc[:self.prefetch_docs].tolist()
+                    )
+                response = await self.model.generate_response_async(
+                    request.query, docs, request.response_type
+                )
+                for doc in response:
+                    doc["link"] = "#"
+                return response
+
+            # Identical concurrent requests share one search and one set of
+            # completions, the shared response must not be modified
+            key = (request.query, request.response_type, request.collection, request.prefetch)
+            return await self._run_query_flights.do(key, generate)
+
+        @self._app.on_event("shutdown")
+        async def close_search_engine():
+            if self.search_engine is not None:
+                await self.search_engine.aclose()
+
+        @self._app.post("/collections/{collection}/feed", status_code=202)
+        def feed_collection(collection: str, request: FeedRequest, background_tasks: BackgroundTasks):
+            # Only files inside the data directory can be fed, the feed runs after the response
+            data_dir = self.data_dir.resolve()
+            for data_file in request.data_files:
+                if not (data_dir / data_file).resolve().is_relative_to(data_dir):
+                    raise HTTPException(status_code=400, detail=f"Invalid data file {data_file}.")
+            search_engine = self._ready_search_engine()
+            if not isinstance(search_engine, SearchEngineLocal) or not search_engine.streaming:
+                raise HTTPException(
+                    status_code=400, detail="Collections can only be fed to a local streaming search engine."
+                )
+            background_tasks.add_task(
+                self.feed_collection, collection, request.data_files, None, request.max_data_samples
             )
-            for doc in response:
-                doc["link"] = "#"
-            return response
+            return {"collection": collection, "data_files": request.data_files}
+
+        @self._app.post("/document_response")
+        def run_document_response(request: DocumentRequest):
+            # Generated (or read from the cache) when a result is expanded in the UI
+            return document_response(request)
+
+        @self._app.post("/run_query_stream")
+        def run_query_stream(request: QueryRequest):
+            # Newline-delimited JSON: the ranked hits first, then LLM tokens per rank
+            docs = search(request)
+
+            def events():
+                for event in self.model.stream_response(
+                    request.query, docs, request.response_type
+                ):
+                    if event["type"] == "results":
+                        for doc in event["docs"]:
+                            doc["link"] = "#"
+                    yield json.dumps(event) + "\n"
 
+            return StreamingResponse(events(), media_type="application/x-ndjson")
 
         static_dir = Path(__file__).parent / "static"
         self._app.mount("/", StaticFiles(directory=static_dir, html=True), name="static")
@@ -1,10 +1,13 @@
 $(document).ready(function() {
+    // Personal libraries are selected with ?collection=<id> in the page URL
+    const collection = new URLSearchParams(window.location.search).get('collection');
+
     function fetchResults(query, responseType) {
         return $.ajax({
             url: 'http://127.0.0.1:8000/run_query',
             type: 'POST',
             contentType: 'application/json',
-            data: JSON.stringify({ query: query, response_type: responseType }),
+            data: JSON.stringify({ query: query, response_type: responseType, collection: collection }),
             success: function(data) {
                 console.log("Success:", data);
             },
@@ -14,7 +17,82 @@ $(document).ready(function() {
         });
     }
 
-    function displayResults(results, detailType = '') {
+    // Reads the NDJSON stream of /run_query_stream, rendering the hits as soon
+    // as they arrive and appending each document's LLM text token by token
+    async function streamResults(query, responseType, detailType) {
+        const response = await fetch('http://127.0.0.1:8000/run_query_stream', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ query: query, response_type: responseType, collection: collection }),
+        });
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) {
+                break;
+            }
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line), query, detailType));
+        }
+    }
+
+    function handleEvent(event, query, detailType) {
+        switch (event.type) {
+            case 'results':
+                // The detail type is already streaming, so no expand buttons are rendered
+                displayResults(event.docs, detailType, query);
+                break;
+            case 'token':
+                appendDetail(event.rank, detailType, event.text);
+                break;
+        }
+    }
+
+    function appendDetail(rank, detailType, text) {
+        const resultItem = $('#results-section .result-item').eq(rank);
+        let details = resultItem.find(`p.${detailType}`);
+        if (details.length === 0) {
+            details = $(`<p class="${detailType}"></p>`);
+            resultItem.children('p').first().after(details);
+        }
+        details.text(details.text() + text);
+    }
+
+    // Generates (or reads from the cache) one document's text when it is expanded
+    function expandResult(query, result, index, responseType, detailType) {
+        const resultItem = $('#results-section .result-item').eq(index);
+        if (resultItem.find(`p.${detailType}`).length > 0) {
+            return;
+        }
+        $.ajax({
+            url: 'http://127.0.0.1:8000/document_response',
+            type: 'POST',
+            contentType: 'application/json',
+            data: JSON.stringify({
+                query: query,
+                doc_id: result.id,
+                response_type: responseType,
+                rank: index,
+                collection: collection
+            }),
+            success: function(data) {
+                appendDetail(index, detailType, data.text);
+            },
+            error: function(xhr, status, error) {
+                console.error("Error:", status, error);
+            }
+        });
+    }
+
+    function displayResults(results, detailType = '', query = '') {
         console.log(displayResults)
         $('.content-section').css('margin-top', '20px');
         const resultsSection = $('#results-section');
@@ -25,14 +103,22 @@ $(document).ready(function() {
                 details = `<p class="${detailType}">${result[detailType]}</p>`;
             }
             const relevance = result.relevance !== undefined ? result.relevance.toFixed(2) : 'N/A';
-            const resultItem = `
+            const expandButtons = detailType ? '' : `
+                    <button class="expand-btn" data-response-type="Informative Summary" data-detail="summary">Summary</button>
+                    <button class="expand-btn" data-response-type="Explain the Reasoning" data-detail="reasoning">Explain</button>
+            `;
+            const resultItem = $(`
                 <div class="result-item">
                     <a href="${result.link || '#'}" target="_blank">${result.title || 'No title available'}</a>
                     <p>${result.body || 'No snippet available'}</p>
                     ${details}
                     <p><strong>Relevance:</strong> ${relevance}</p>
+                    ${expandButtons}
                 </div>
-            `;
+            `);
+            resultItem.find('.expand-btn').on('click', function() {
+                expandResult(query, result, index, $(this).data('response-type'), $(this).data('detail'));
+            });
             resultsSection.append(resultItem);
         });
         resultsSection.show();
@@ -47,7 +133,7 @@ $(document).ready(function() {
         const query = $('#search-input').val();
         fetchResults(query, 'Just Show the Results')
             .done(function(results) {
-                displayResults(results);
+                displayResults(results, '', query);
                 markButtonSelected('show-btn');
             })
             .fail(function() {
@@ -57,25 +143,19 @@ $(document).ready(function() {
 
     $('#explain-btn').on('click', function() {
         const query = $('#search-input').val();
-        fetchResults(query, 'Explain the Reasoning')
-            .done(function(results) {
-                displayResults(results, 'reasoning');
-                markButtonSelected('explain-btn');
-            })
-            .fail(function() {
-                console.error('Error fetching results');
+        markButtonSelected('explain-btn');
+        streamResults(query, 'Explain the Reasoning', 'reasoning')
+            .catch(function(error) {
+                console.error('Error fetching results', error);
             });
     });
 
     $('#summary-btn').on('click', function() {
         const query = $('#search-input').val();
-        fetchResults(query, 'Informative Summary')
-            .done(function(results) {
-                displayResults(results, 'summary');
-                markButtonSelected('summary-btn');
-            })
-            .fail(function() {
-                console.error('Error fetching results');
+        markButtonSelected('summary-btn');
+        streamResults(query, 'Informative Summary', 'summary')
+            .catch(function(error) {
+                console.error('Error fetching results', error);
             });
     });
 });
@@ -1,2 +1,4 @@
+from .budget import PromptBudget
+from .cache import CompletionCache
 from .llm import LLM
 from .search_engine import SearchEngineCloud, SearchEngineLocal
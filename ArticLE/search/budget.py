@@ -0,0 +1,54 @@
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+class PromptBudget:
+    # Rough characters per token when the model's tokenizer is not available
+    chars_per_token = 4
+
+    def __init__(
+        self,
+        model: str = "gpt-3.5-turbo",
+        input_tokens: int = 512,
+        response_tokens: dict[str, int] | None = None,
+        default_response_tokens: int = 150
+    ) -> None:
+        self.model = model
+        self.input_tokens = input_tokens
+        self.response_tokens = {"summary": 150, "reasoning": 100} | (response_tokens or {})
+        self.default_response_tokens = default_response_tokens
+
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                try:
+                    self.encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    self.encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                # The BPE files are downloaded on first use, so an offline box
+                # falls back to the characters per token estimate
+                print(f"Could not load the tokenizer for {model}, estimating tokens: {e}")
+
+    def count(self, text: str) -> int:
+        if self.encoding is None:
+            return -(-len(text) // self.chars_per_token)
+        return len(self.encoding.encode(text))
+
+    def truncate(self, text: str, tokens: int) -> str:
+        if tokens <= 0:
+            return ""
+        if self.encoding is None:
+            return text[:tokens * self.chars_per_token]
+        encoded = self.encoding.encode(text)
+        return text if len(encoded) <= tokens else self.encoding.decode(encoded[:tokens])
+
+    def pack(self, title: str, body: str) -> tuple[str, str]:
+        # The title always fits first, the abstract gets whatever is left
+        title = self.truncate(title, self.input_tokens)
+        return title, self.truncate(body, self.input_tokens - self.count(title))
+
+    def max_tokens(self, column_name: str) -> int:
+        return self.response_tokens.get(column_name, self.default_response_tokens)
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class CompletionCache:
+    def __init__(
+        self,
+        path: Path | str = Path("data") / "completions.sqlite",
+        max_entries: int = 10_000
+    ) -> None:
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, model TEXT, max_tokens INTEGER, "
+                "completion TEXT, last_used REAL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)"
+            )
+
+    @staticmethod
+    def key(model: str, max_tokens: int, messages: list[dict[str, str]]) -> str:
+        prompt = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(f"{model}\0{max_tokens}\0{prompt}".encode()).hexdigest()
+
+    def get(self, model: str, max_tokens: int, messages: list[dict[str, str]]) -> str | None:
+        key = self.key(model, max_tokens, messages)
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT completion FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.hits += 1
+            return row[0]
+
+    def set(
+        self,
+        model: str,
+        max_tokens: int,
+        messages: list[dict[str, str]],
+        completion: str
+    ) -> None:
+        key = self.key(model, max_tokens, messages)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                (key, model, max_tokens, completion, time.time())
+            )
+            # Evict the least recently used completions above the size bound
+            self._connection.execute(
+                "DELETE FROM completions WHERE key IN ("
+                "SELECT key FROM completions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def metrics(self) -> dict[str, float]:
+        with self._lock:
+            size = self._connection.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "size": size,
+        }
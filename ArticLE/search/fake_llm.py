@@ -0,0 +1,209 @@
+import json
+import random
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Iterator
+
+WORDS = (
+    "the article studies a method for retrieval with dense and sparse signals "
+    "and reports results on several benchmarks showing consistent improvements"
+).split()
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code: int, retry_after: float | None = None) -> None:
+        super().__init__(f"Fake provider error {status_code}")
+        self.status_code = status_code
+        headers = {} if retry_after is None else {"retry-after": str(retry_after)}
+        self.response = SimpleNamespace(status_code=status_code, headers=headers)
+
+
+@dataclass
+class FakeLLMConfig:
+    # Time to first token follows a lognormal distribution around the median
+    latency_median: float = 0.5
+    latency_sigma: float = 0.5
+    tokens_per_second: float = 50.0
+    rate_limit_probability: float = 0.0
+    server_error_probability: float = 0.0
+    retry_after: float | None = 1.0
+    seed: int | None = None
+    rng: random.Random = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.rng = random.Random(self.seed)
+
+
+# In-process stand-in for the OpenAI and Groq clients: chat.completions.create
+# answers with placeholder text after a simulated latency and can inject errors
+class FakeLLMClient:
+    def __init__(self, config: FakeLLMConfig | None = None) -> None:
+        self.config = FakeLLMConfig() if config is None else config
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def _latency(self) -> float:
+        return self.config.rng.lognormvariate(0, self.config.latency_sigma) * self.config.latency_median
+
+    def _raise_injected_error(self) -> None:
+        draw = self.config.rng.random()
+        if draw < self.config.rate_limit_probability:
+            raise FakeAPIError(429, self.config.retry_after)
+        if draw < self.config.rate_limit_probability + self.config.server_error_probability:
+            raise FakeAPIError(500)
+
+    def _content(self, messages: list[dict[str, str]], max_tokens: int, json_mode: bool) -> str:
+        # The rubrics are often in the system or first message, so every message is inspected
+        prompt = "\n".join(message["content"] for message in messages)
+        n_words = max(1, min(max_tokens, 60))
+        text = " ".join(self.config.rng.choice(WORDS) for _ in range(n_words))
+        if json_mode or "json" in prompt.lower():
+            ids = re.findall(r"Document id (\d+)", prompt)
+            if ids:
+                return json.dumps({id: text for id in ids})
+            ids = re.findall(r"Article id (\d+):", prompt)
+            if ids:
+                return json.dumps({"judgements": [
+                    {"id": id, "explanation": text, "eval": str(self.config.rng.randint(0, 3))} for id in ids
+                ]})
+            return json.dumps({"explanation": text, "eval": str(self.config.rng.randint(0, 3))})
+        if "0, 1, 2, or 3" in prompt:
+            return str(self.config.rng.randint(0, 3))
+        if "number 1 or 0" in prompt:
+            return str(self.config.rng.randint(0, 1))
+        return text
+
+    @staticmethod
+    def _count(messages: list[dict[str, str]]) -> int:
+        return sum(len(message["content"].split()) for message in messages)
+
+    def create(
+        self,
+        model: str,
+        messages: list[dict[str, str]],
+        max_tokens: int | None = None,
+        stream: bool = False,
+        response_format: dict | None = None,
+        **kwargs
+    ):
+        time.sleep(self._latency())
+        self._raise_injected_error()
+
+        json_mode = response_format is not None and response_format.get("type") == "json_object"
+        content = self._content(messages, max_tokens or 256, json_mode)
+        if stream:
+            return self._stream(model, content)
+
+        time.sleep(len(content.split()) / self.config.tokens_per_second)
+        completion_tokens = len(content.split())
+        prompt_tokens = self._count(messages)
+        return SimpleNamespace(
+            id=f"chatcmpl-{uuid.uuid4().hex}",
+            model=model,
+            choices=[SimpleNamespace(
+                index=0,
+                message=SimpleNamespace(role="assistant", content=content),
+                finish_reason="stop",
+            )],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
+
+    def _stream(self, model: str, content: str) -> Iterator[SimpleNamespace]:
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            time.sleep(1 / self.config.tokens_per_second)
+            yield SimpleNamespace(
+                model=model,
+                choices=[SimpleNamespace(
+                    index=0,
+                    delta=SimpleNamespace(content=word if i == 0 else " " + word),
+                    finish_reason=None if i < len(words) - 1 else "stop",
+                )],
+            )
+
+
+# OpenAI-compatible chat completions server around a FakeLLMClient. The app is
+# pointed at it with OPENAI_BASE_URL=http://localhost:8001/v1 and the evaluator
+# with GROQ_BASE_URL=http://localhost:8001
+def create_app(client: FakeLLMClient | None = None):
+    from fastapi import FastAPI, Request
+    from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    client = FakeLLMClient() if client is None else client
+    app = FastAPI()
+
+    def to_dict(namespace):
+        if isinstance(namespace, SimpleNamespace):
+            return {key: to_dict(value) for key, value in vars(namespace).items()}
+        if isinstance(namespace, list):
+            return [to_dict(value) for value in namespace]
+        return namespace
+
+    @app.post("/v1/chat/completions")
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        try:
+            response = await run_in_threadpool(
+                client.create,
+                model=body.get("model", "fake"),
+                messages=body["messages"],
+                max_tokens=body.get("max_tokens"),
+                stream=body.get("stream", False),
+                response_format=body.get("response_format"),
+            )
+        except FakeAPIError as e:
+            return JSONResponse(
+                {"error": {"message": str(e), "type": "fake_error", "code": e.status_code}},
+                status_code=e.status_code,
+                headers=e.response.headers,
+            )
+
+        if not body.get("stream", False):
+            return to_dict(response) | {"object": "chat.completion", "created": int(time.time())}
+
+        async def events():
+            async for chunk in iterate_in_threadpool(response):
+                chunk = to_dict(chunk) | {
+                    "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time())
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Fake OpenAI/Groq chat completions server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-median", type=float, default=0.5)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0)
+    parser.add_argument("--server-error-probability", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = FakeLLMConfig(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        rate_limit_probability=args.rate_limit_probability,
+        server_error_probability=args.server_error_probability,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(FakeLLMClient(config)), host=args.host, port=args.port)
@@ -1,20 +1,72 @@
-from typing import Callable, Literal
+import asyncio
+import json
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Literal
 
 import pandas as pd
 import tqdm
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+
+from .budget import PromptBudget
+from .cache import CompletionCache
+from .rate_limit import RateLimitedClient
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+ResponseType = Literal["Informative Summary", "Explain the Reasoning", "Just Show the Results"]
+
 
 class LLM:
-    def __init__(self, max_docs: int = 2, api_key: str | None = None) -> None:
+    def __init__(
+        self,
+        max_docs: int = 2,
+        api_key: str | None = None,
+        max_workers: int = 4,
+        timeout: float = 20.0,
+        cache: CompletionCache | None = None,
+        model: str = "gpt-3.5-turbo",
+        budget: PromptBudget | None = None,
+        batched: bool = False,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float | None = 60_000,
+        base_url: str | None = None,
+        client=None,
+        max_async_concurrency: int = 64
+    ) -> None:
         self.max_docs = max_docs
-        self.client = OpenAI(api_key=api_key)
+        self.batched = batched
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.cache = cache
+        self.model = model
+        self.budget = PromptBudget(model) if budget is None else budget
+        # Retries are left to the rate limiter, bounded so a request never waits
+        # much longer than one completion timeout
+        # client accepts any stand-in with the chat.completions.create interface,
+        # its async calls then run in threads
+        self.client = RateLimitedClient(
+            OpenAI(api_key=api_key, base_url=base_url, max_retries=0) if client is None
+            else client,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_concurrency=max_workers,
+            max_retries=2,
+            max_delay=timeout,
+            async_client=(
+                AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0) if client is None
+                else None
+            ),
+            max_async_concurrency=max_async_concurrency
+        )
 
-    @staticmethod
-    def _get_context_string(title: str, body: str) -> str:
+    def _get_context_string(self, title: str, body: str) -> str:
+        title, body = self.budget.pack(title, body)
         return (
             f"You are given a document with the following title:\n{title}\n"
             f"The content of the document is as follows:\n{body}\n"
@@ -47,6 +99,152 @@ class LLM:
             f"at rank {index + 1} in response to the following question:\n\"{question}\""
         )
 
+    def _get_batched_prompt(
+        self,
+        column_name: str,
+        docs: pd.DataFrame,
+        question: str
+    ) -> str:
+        documents = "".join(
+            f"Document id {index} (rank {index + 1}):\n"
+            "Title: {}\nContent: {}\n\n".format(*self.budget.pack(doc["title"], doc["body"]))
+            for index, doc in docs.iterrows()
+        )
+        match column_name:
+            case "summary":
+                task = (
+                    "Write a brief one paragraph summary of each document in "
+                    f"response to the following question:\n\"{question}\"\n"
+                )
+            case "reasoning":
+                task = (
+                    "We are using a search engine to find information on an article database."
+                    "The search engine is using a hybrid serach with the "
+                    "HNSW and BM25 algorithms to rank documents.\n"
+                    "Explain briefly why the search engine returned each document "
+                    f"at its rank in response to the following question:\n\"{question}\"\n"
+                )
+        return (
+            f"You are given the following documents:\n\n{documents}{task}"
+            "Answer with a JSON object that maps every document id to its answer, "
+            "for example {\"0\": \"...\", \"1\": \"...\"}."
+        )
+
+    @staticmethod
+    def _parse_batched_completion(completion: str, ids: list[str]) -> dict[str, str]:
+        answers = json.loads(completion)
+        if not isinstance(answers, dict) or sorted(answers) != sorted(ids):
+            raise ValueError(f"Expected answers for document ids {ids}, got {completion!r}")
+        if not all(isinstance(answer, str) and answer.strip() for answer in answers.values()):
+            raise ValueError(f"Empty answer in {completion!r}")
+        return {id: answer.strip() for id, answer in answers.items()}
+
+    def _log_usage(self, response, max_tokens: int) -> None:
+        logger.info(
+            "%s completion: %d prompt tokens, %d completion tokens (max_tokens=%d)",
+            self.model, response.usage.prompt_tokens, response.usage.completion_tokens, max_tokens
+        )
+
+    def _complete_batched(
+        self, prompt: str, ids: list[str], max_tokens: int
+    ) -> dict[str, str] | None:
+        # One request for all documents, the answer budget grows with their count
+        messages = self._get_messages(prompt)
+        max_tokens = max_tokens * len(ids)
+        if self.cache is not None:
+            completion = self.cache.get(self.model, max_tokens, messages)
+            if completion is not None:
+                try:
+                    return self._parse_batched_completion(completion, ids)
+                except ValueError:
+                    pass
+
+        try:
+            response = self.client.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                response_format={"type": "json_object"},
+                timeout=self.timeout
+            )
+            self._log_usage(response, max_tokens)
+            completion = response.choices[0].message.content
+            answers = self._parse_batched_completion(completion, ids)
+        except Exception as e:
+            print(f"Error while generating a batched response: {e}")
+            return None
+
+        if self.cache is not None:
+            self.cache.set(self.model, max_tokens, messages, completion)
+        return answers
+
+    @staticmethod
+    def _get_messages(prompt: str) -> list[dict[str, str]]:
+        return [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt}
+        ]
+
+    def _get_task(
+        self, response_type: ResponseType
+    ) -> tuple[str, Callable[[int, pd.Series, str], str]] | None:
+        match response_type:
+            case "Informative Summary":
+                return "summary", self._get_informative_summary_prompt
+            case "Explain the Reasoning":
+                return "reasoning", self._get_explain_the_reasoning_prompt
+            case "Just Show the Results":
+                return None
+
+    def _complete(self, prompt: str, max_tokens: int) -> str | None:
+        messages = self._get_messages(prompt)
+        if self.cache is not None:
+            completion = self.cache.get(self.model, max_tokens, messages)
+            if completion is not None:
+                return completion
+
+        try:
+            response = self.client.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                timeout=self.timeout
+            )
+        except Exception as e:
+            # A failed completion only leaves its document without a response
+            print(f"Error while generating a response: {e}")
+            return None
+
+        self._log_usage(response, max_tokens)
+        completion = response.choices[0].message.content.strip()
+        if self.cache is not None:
+            self.cache.set(self.model, max_tokens, messages, completion)
+        return completion
+
+    async def _complete_async(self, prompt: str, max_tokens: int) -> str | None:
+        messages = self._get_messages(prompt)
+        if self.cache is not None:
+            completion = await asyncio.to_thread(self.cache.get, self.model, max_tokens, messages)
+            if completion is not None:
+                return completion
+
+        try:
+            response = await self.client.create_async(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                timeout=self.timeout
+            )
+        except Exception as e:
+            print(f"Error while generating a response: {e}")
+            return None
+
+        self._log_usage(response, max_tokens)
+        completion = response.choices[0].message.content.strip()
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.set, self.model, max_tokens, messages, completion)
+        return completion
+
     def process_docs(
         self,
         question: str,
@@ -56,42 +254,185 @@ class LLM:
     ) -> pd.DataFrame:
         docs = docs.copy()
         docs[column_name] = pd.NA
-        # For the first few documents, generate a response
-        for index, doc in tqdm.tqdm(
-            docs.iloc[:self.max_docs].iterrows(), total=min(self.max_docs, len(docs))
-        ):
-            prompt = prompt_modifier(index, doc, question)
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=150
+        selected = docs.iloc[:self.max_docs]
+        max_tokens = self.budget.max_tokens(column_name)
+        if self.batched:
+            ids = [str(index) for index in selected.index]
+            answers = self._complete_batched(
+                self._get_batched_prompt(column_name, selected, question), ids, max_tokens
+            )
+            if answers is not None:
+                for index in selected.index:
+                    docs.at[index, column_name] = answers[str(index)]
+                return docs
+            # Fall back to one completion per document
+
+        # For the first few documents, generate the responses concurrently
+        prompts = [prompt_modifier(index, doc, question) for index, doc in selected.iterrows()]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(prompts)))) as executor:
+            responses = list(tqdm.tqdm(
+                executor.map(self._complete, prompts, [max_tokens] * len(prompts)),
+                total=len(prompts)
+            ))
+
+        for index, response in zip(selected.index, responses):
+            if response is not None:
+                docs.at[index, column_name] = response
+        return docs
+
+    async def process_docs_async(
+        self,
+        question: str,
+        column_name: str,
+        docs: pd.DataFrame,
+        prompt_modifier: Callable[[int, pd.Series, str], str]
+    ) -> pd.DataFrame:
+        if self.batched:
+            # The batched request and its per-document fallback stay synchronous
+            return await asyncio.to_thread(
+                self.process_docs, question, column_name, docs, prompt_modifier
             )
-            docs.at[index, column_name] = response.choices[0].message.content.strip()
+
+        docs = docs.copy()
+        docs[column_name] = pd.NA
+        selected = docs.iloc[:self.max_docs]
+        max_tokens = self.budget.max_tokens(column_name)
+        prompts = [prompt_modifier(index, doc, question) for index, doc in selected.iterrows()]
+        responses = await asyncio.gather(*(self._complete_async(prompt, max_tokens) for prompt in prompts))
+
+        for index, response in zip(selected.index, responses):
+            if response is not None:
+                docs.at[index, column_name] = response
+        return docs
+
+    def _stream_completion(self, prompt: str, max_tokens: int) -> Iterator[str]:
+        messages = self._get_messages(prompt)
+        if self.cache is not None:
+            completion = self.cache.get(self.model, max_tokens, messages)
+            if completion is not None:
+                yield completion
+                return
+
+        stream = self.client.create(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            timeout=self.timeout,
+            stream=True
+        )
+        completion = ""
+        for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            completion += chunk.choices[0].delta.content
+            yield chunk.choices[0].delta.content
+
+        logger.info(
+            "%s streamed completion: %d prompt tokens, %d completion tokens (max_tokens=%d)",
+            self.model, self.budget.count(prompt), self.budget.count(completion), max_tokens
+        )
+        if self.cache is not None:
+            self.cache.set(self.model, max_tokens, messages, completion.strip())
+
+    @staticmethod
+    def _prepare_docs(docs: pd.DataFrame) -> pd.DataFrame:
+        docs["title"] = docs["title"].str.replace("\n", " ")
+        docs["body"] = docs["body"].str.replace("\n", " ")
+        return docs
+
+    @staticmethod
+    def _truncate_for_display(docs: pd.DataFrame) -> pd.DataFrame:
+        # The prompts get the budgeted abstract, the results only show a snippet
+        docs = docs.copy()
+        docs["body"] = docs["body"].str[:100] + "..."
         return docs
 
     def generate_response(
         self,
         question: str,
         docs: pd.DataFrame,
-        response_type: Literal[
-            "Informative Summary", "Explain the Reasoning", "Just Show the Results"
-        ] = "Just Show the Results"
+        response_type: ResponseType = "Just Show the Results"
     ):
-        docs["title"] = docs["title"].str.replace("\n", " ")
-        docs["body"] = docs["body"].str.replace("\n", " ").str[:100] + "..."
+        docs = self._prepare_docs(docs)
         # Generate prompts for the LLM based on response type
-        match response_type:
-            case "Informative Summary":
-                docs = self.process_docs(
-                    question, "summary", docs, self._get_informative_summary_prompt
-                )
-            case "Explain the Reasoning":
-                docs = self.process_docs(
-                    question, "reasoning", docs, self._get_explain_the_reasoning_prompt
-                )
-            case "Just Show the Results":
-                pass
-        return docs.to_dict(orient="records")
+        task = self._get_task(response_type)
+        if task is not None:
+            column_name, prompt_modifier = task
+            docs = self.process_docs(question, column_name, docs, prompt_modifier)
+        return self._truncate_for_display(docs).to_dict(orient="records")
+
+    async def generate_response_async(
+        self,
+        question: str,
+        docs: pd.DataFrame,
+        response_type: ResponseType = "Just Show the Results"
+    ) -> list[dict]:
+        # Completions are awaited concurrently, the DataFrame work runs in threads
+        docs = await asyncio.to_thread(self._prepare_docs, docs)
+        task = self._get_task(response_type)
+        if task is not None:
+            column_name, prompt_modifier = task
+            docs = await self.process_docs_async(question, column_name, docs, prompt_modifier)
+        return await asyncio.to_thread(
+            lambda: self._truncate_for_display(docs).to_dict(orient="records")
+        )
+
+    def generate_document_response(
+        self,
+        question: str,
+        doc: dict[str, str],
+        response_type: ResponseType,
+        rank: int = 0
+    ) -> str | None:
+        # A single document's answer, shared with the eager modes through the cache
+        task = self._get_task(response_type)
+        if task is None:
+            raise ValueError(f"Response type {response_type!r} does not generate text.")
+        column_name, prompt_modifier = task
+        doc = self._prepare_docs(pd.DataFrame([doc])).iloc[0]
+        return self._complete(
+            prompt_modifier(rank, doc, question), self.budget.max_tokens(column_name)
+        )
+
+    def stream_response(
+        self,
+        question: str,
+        docs: pd.DataFrame,
+        response_type: ResponseType = "Just Show the Results"
+    ) -> Iterator[dict]:
+        docs = self._prepare_docs(docs).reset_index(drop=True)
+        yield {"type": "results", "docs": self._truncate_for_display(docs).to_dict(orient="records")}
+
+        task = self._get_task(response_type)
+        if task is None:
+            return
+        column_name, prompt_modifier = task
+        max_tokens = self.budget.max_tokens(column_name)
+
+        # Every document streams from its own thread, events are yielded as they arrive
+        events = queue.Queue()
+
+        def worker(rank: int, doc: pd.Series) -> None:
+            try:
+                prompt = prompt_modifier(rank, doc, question)
+                for text in self._stream_completion(prompt, max_tokens):
+                    events.put({"type": "token", "rank": rank, "column": column_name, "text": text})
+            except Exception as e:
+                print(f"Error while streaming a response: {e}")
+                events.put({"type": "error", "rank": rank, "column": column_name})
+            finally:
+                events.put({"type": "done", "rank": rank, "column": column_name})
+
+        workers = [
+            threading.Thread(target=worker, args=(rank, doc), daemon=True)
+            for rank, doc in docs.iloc[:self.max_docs].iterrows()
+        ]
+        for thread in workers:
+            thread.start()
+
+        pending = len(workers)
+        while pending:
+            event = events.get()
+            if event["type"] == "done":
+                pending -= 1
+            yield event
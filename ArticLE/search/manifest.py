@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Sequence
+
+from vespa.package import ApplicationPackage
+
+FORMAT_VERSION = 1
+
+
+def schema_version(package: ApplicationPackage) -> str:
+    digest = hashlib.sha256()
+    for schema in package.schemas:
+        digest.update(schema.schema_to_text.encode())
+    digest.update(package.services_to_text.encode())
+    return digest.hexdigest()[:16]
+
+
+@dataclass
+class Segment:
+    data_files: list[str]
+    start: int
+    stop: int
+    collection: str | None = None
+
+
+@dataclass
+class IndexManifest:
+    schema_version: str
+    generation: int = 0
+    segments: list[Segment] = field(default_factory=list)
+    format_version: int = FORMAT_VERSION
+
+    @classmethod
+    def load(cls, path: Path | str, schema_version: str) -> "IndexManifest":
+        path = Path(path)
+        if not path.exists():
+            return cls(schema_version)
+
+        data = json.loads(path.read_text())
+        manifest = cls(
+            schema_version=data["schema_version"],
+            generation=data["generation"],
+            segments=[Segment(**segment) for segment in data["segments"]],
+            format_version=data["format_version"],
+        )
+        if (
+            manifest.format_version != FORMAT_VERSION
+            or manifest.schema_version != schema_version
+        ):
+            # The deployed documents no longer match the package, start a new generation
+            return cls(schema_version, generation=manifest.generation + 1)
+        return manifest
+
+    def save(self, path: Path | str) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        tmp_path.write_text(json.dumps(asdict(self), indent=2))
+        os.replace(tmp_path, path)
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.segments
+
+    def fed_until(self, data_files: Sequence[str], collection: str | None = None) -> int:
+        stops = [
+            segment.stop for segment in self.segments
+            if segment.data_files == list(data_files) and segment.collection == collection
+        ]
+        return max(stops, default=0)
+
+    def reset(self) -> None:
+        self.segments = []
+        self.generation += 1
+
+    def append(
+        self,
+        data_files: Sequence[str],
+        start: int,
+        stop: int,
+        collection: str | None = None
+    ) -> None:
+        last = self.segments[-1] if self.segments else None
+        if (
+            last is not None and last.data_files == list(data_files)
+            and last.collection == collection and last.stop == start
+        ):
+            last.stop = stop
+        else:
+            self.segments.append(Segment(list(data_files), start, stop, collection))
+        self.generation += 1
@@ -0,0 +1,160 @@
+import asyncio
+import random
+import threading
+import time
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: float | None = None) -> None:
+        self.rate = rate_per_minute / 60
+        self.capacity = rate_per_minute if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _try_acquire(self, amount: float) -> float:
+        # Returns 0 once the tokens are taken, otherwise the seconds to wait
+        # Requests larger than the bucket wait for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.rate
+
+    def acquire(self, amount: float = 1) -> None:
+        while wait := self._try_acquire(amount):
+            time.sleep(wait)
+
+    async def acquire_async(self, amount: float = 1) -> None:
+        while wait := self._try_acquire(amount):
+            await asyncio.sleep(wait)
+
+    def refund(self, amount: float) -> None:
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+# Chat completions of an OpenAI or Groq client behind requests and tokens per
+# minute buckets, a concurrency limit and bounded exponential backoff. The
+# async path shares the buckets with the sync one but has its own limit on
+# concurrent requests, since awaiting requests hold no threads
+class RateLimitedClient:
+    def __init__(
+        self,
+        client,
+        requests_per_minute: float = 30,
+        tokens_per_minute: float | None = 6000,
+        max_concurrency: int = 4,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        async_client=None,
+        max_async_concurrency: int | None = None
+    ) -> None:
+        self.client = client
+        self.async_client = async_client
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = None if tokens_per_minute is None else TokenBucket(tokens_per_minute)
+        self.concurrency = threading.BoundedSemaphore(max_concurrency)
+        self.max_async_concurrency = (
+            max_concurrency if max_async_concurrency is None else max_async_concurrency
+        )
+        # Created on first use, inside the event loop that awaits it
+        self._async_concurrency = None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def estimate_tokens(messages: list[dict[str, str]], max_tokens: int) -> int:
+        return sum(len(message["content"]) for message in messages) // 4 + max_tokens
+
+    @staticmethod
+    def _status_code(error: Exception) -> int | None:
+        status_code = getattr(error, "status_code", None)
+        response = getattr(error, "response", None)
+        return status_code if status_code is not None else getattr(response, "status_code", None)
+
+    @staticmethod
+    def _retry_after(error: Exception) -> float | None:
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        try:
+            return float(headers["retry-after"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _is_retryable(self, error: Exception) -> bool:
+        status_code = self._status_code(error)
+        if status_code is None:
+            # Connection errors and timeouts carry no status code
+            return type(error).__name__ in {"APIConnectionError", "APITimeoutError", "TimeoutError"}
+        return status_code in RETRYABLE_STATUS_CODES
+
+    def _delay(self, attempt: int, error: Exception) -> float:
+        retry_after = self._retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # Full jitter keeps concurrent workers from retrying in lockstep
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def create(self, **kwargs):
+        estimate = self.estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens") or 0)
+        for attempt in range(self.max_retries + 1):
+            self.requests.acquire()
+            if self.tokens is not None:
+                self.tokens.acquire(estimate)
+            try:
+                with self.concurrency:
+                    response = self.client.chat.completions.create(**kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not self._is_retryable(e):
+                    raise
+                delay = self._delay(attempt, e)
+                print(f"Retrying completion in {delay:.1f}s after error: {e}")
+                time.sleep(delay)
+                continue
+
+            self._refund(response, estimate)
+            return response
+
+    def _refund(self, response, estimate: int) -> None:
+        usage = getattr(response, "usage", None)
+        if self.tokens is not None and usage is not None:
+            self.tokens.refund(max(0, estimate - usage.total_tokens))
+
+    async def create_async(self, **kwargs):
+        if self.async_client is None:
+            # Clients without an async counterpart run in the default thread pool
+            return await asyncio.to_thread(self.create, **kwargs)
+        if self._async_concurrency is None:
+            self._async_concurrency = asyncio.Semaphore(self.max_async_concurrency)
+
+        estimate = self.estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens") or 0)
+        for attempt in range(self.max_retries + 1):
+            await self.requests.acquire_async()
+            if self.tokens is not None:
+                await self.tokens.acquire_async(estimate)
+            try:
+                async with self._async_concurrency:
+                    response = await self.async_client.chat.completions.create(**kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not self._is_retryable(e):
+                    raise
+                delay = self._delay(attempt, e)
+                print(f"Retrying completion in {delay:.1f}s after error: {e}")
+                await asyncio.sleep(delay)
+                continue
+
+            self._refund(response, estimate)
+            return response
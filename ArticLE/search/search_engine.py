@@ -1,17 +1,31 @@
+import asyncio
+import threading
 from collections import defaultdict
 from pathlib import Path
 from typing import Iterable, Sequence
 
 import datasets
+import docker
 import pandas as pd
+import requests
 from vespa.application import Vespa
-from vespa.package import ApplicationPackage, Field, Schema, Document, RankProfile, HNSW, RankProfile, Component, Parameter, FieldSet, GlobalPhaseRanking, Function
+from vespa.package import ApplicationPackage, Field, Schema, Document, RankProfile, HNSW, RankProfile, Component, Parameter, FieldSet, GlobalPhaseRanking, Function, SecondPhaseRanking
 from vespa.deployment import VespaDocker
 from vespa.io import VespaResponse, VespaQueryResponse
 
+from .manifest import IndexManifest, schema_version
+
 
 class SearchEngine:
     app: Vespa
+    binary_quantization: bool = False
+    streaming: bool = False
+    default_collection: str = "article-groupname"
+    target_hits: int = 100
+    # Connections of the pooled session shared by all in-flight async queries
+    async_connections: int = 64
+    _async_session = None
+    _async_session_lock: asyncio.Lock | None = None
 
     def _hits_to_df(self, response: VespaQueryResponse) -> pd.DataFrame:
         fields = ["id", "title", "body"]
@@ -24,22 +38,51 @@ class SearchEngine:
 
         return pd.DataFrame(records)
 
+    def _query_params(self, query: str, n_hits: int, collection: str | None = None) -> dict:
+        params = self._ranking_params(query, n_hits)
+        if self.streaming:
+            # Streaming search only scans the documents of the requested group
+            params["groupname"] = collection or self.default_collection
+        elif collection is not None:
+            raise ValueError("Collections are only supported by streaming search engines.")
+        return params
+
+    def _ranking_params(self, query: str, n_hits: int) -> dict:
+        if not self.binary_quantization:
+            return {
+                "body": {"input.query(q)": f"embed({query})"},
+                "ranking": "fusion",
+                "yql": f"select * from sources * where userQuery() limit {n_hits}",
+            }
+        # Candidates come from the hamming HNSW and are reranked in full precision
+        return {
+            "body": {
+                "input.query(q)": f"embed({query})",
+                "input.query(q_binary)": f"embed({query})",
+            },
+            "ranking": "fusion_binary",
+            "yql": (
+                "select * from sources * where userQuery() or "
+                f"({{targetHits:{max(self.target_hits, n_hits)}}}"
+                f"nearestNeighbor(embedding_binary, q_binary)) limit {n_hits}"
+            ),
+        }
+
     def _search(
         self,
         queries: Iterable[str],
         n_hits: int,
         connect_timeout: float = 50.0,
-        read_timeout: float = 100.0
+        read_timeout: float = 100.0,
+        collection: str | None = None
     ) -> list[VespaQueryResponse]:
         results = []
         with self.app.syncio(connections=1) as session:
             for i, query in enumerate(queries, start=1):
                 response = session.query(
-                    body={"input.query(q)": f"embed({query})"},
                     query=query,
-                    ranking="fusion",
                     timeout=(connect_timeout, read_timeout),
-                    yql=f"select * from sources * where userQuery() limit {n_hits}",
+                    **self._query_params(query, n_hits, collection)
                 )
                 if not response.is_successful():
                     raise RuntimeError(
@@ -48,62 +91,179 @@ class SearchEngine:
                 results.append(response)
         return results
 
-    def search(self, query: str, n_hits: int = 10, timeout: float = 5.0) -> pd.DataFrame:
-        response = self._search([query], n_hits, timeout)[0]
+    def search(
+        self,
+        query: str,
+        n_hits: int = 10,
+        timeout: float = 5.0,
+        collection: str | None = None
+    ) -> pd.DataFrame:
+        response = self._search([query], n_hits, timeout, collection=collection)[0]
         return self._hits_to_df(response)
 
+    async def _get_async_session(self):
+        # The lock is created without awaiting, so it is unique per engine
+        if self._async_session_lock is None:
+            self._async_session_lock = asyncio.Lock()
+        async with self._async_session_lock:
+            if self._async_session is None:
+                self._async_session_context = self.app.asyncio(connections=self.async_connections)
+                self._async_session = await self._async_session_context.__aenter__()
+        return self._async_session
+
+    async def search_async(
+        self,
+        query: str,
+        n_hits: int = 10,
+        timeout: float = 5.0,
+        collection: str | None = None
+    ) -> pd.DataFrame:
+        session = await self._get_async_session()
+        response = await session.query(
+            query=query,
+            timeout=timeout,
+            **self._query_params(query, n_hits, collection)
+        )
+        if not response.is_successful():
+            raise RuntimeError(f"Query failed with HTTP status code {response.status_code}")
+        return await asyncio.to_thread(self._hits_to_df, response)
+
+    async def aclose(self) -> None:
+        if self._async_session is not None:
+            await self._async_session_context.__aexit__(None, None, None)
+            self._async_session = None
+
+    def get_document(self, doc_id: str, collection: str | None = None) -> dict[str, str] | None:
+        if self.streaming:
+            collection = collection or self.default_collection
+        elif collection is not None:
+            raise ValueError("Collections are only supported by streaming search engines.")
+
+        response = self.app.get_data(
+            schema="doc", data_id=doc_id, namespace="article", groupname=collection
+        )
+        if not response.is_successful():
+            return None
+        fields = response.get_json()["fields"]
+        return {"id": fields["id"], "title": fields["title"], "body": fields["body"]}
+
 
 class SearchEngineCloud(SearchEngine):
-    def __init__(self, endpoint: str, cert_path: Path | str, key_path: Path | str) -> None:
+    def __init__(
+        self,
+        endpoint: str,
+        cert_path: Path | str,
+        key_path: Path | str,
+        binary_quantization: bool = False,
+        streaming: bool = False
+    ) -> None:
         self.endpoint = endpoint
         self.cert_path = cert_path
         self.key_path = key_path
+        self.binary_quantization = binary_quantization
+        self.streaming = streaming
         self.app = Vespa(self.endpoint, cert=self.cert_path, key=self.key_path)
 
 
 class SearchEngineLocal(SearchEngine):
+    manifest_name = "index_manifest.json"
+
     def __init__(
         self,
         data_dir: Path | str,
         data_files: Sequence[str],
         max_data_samples: int | None = None,
+        manifest_path: Path | str | None = None,
+        binary_quantization: bool = False,
+        streaming: bool = False,
+        collection: str | None = None,
+        feed: bool = True,
         **kwargs
     ) -> None:
+        self.binary_quantization = binary_quantization
+        self.streaming = streaming
+        # Documents fed so far out of the corpus size, read by the app's readiness probe
+        self.fed_documents = 0
+        self.failed_documents = 0
+        self.total_documents = 0
+        self._feed_lock = threading.Lock()
         self.set_package()
+        self.manifest_path = (
+            Path(data_dir) / self.manifest_name if manifest_path is None
+            else Path(manifest_path)
+        )
+        self.manifest = IndexManifest.load(self.manifest_path, schema_version(self.package))
+        self.set_app()
+        # With feed=False the caller feeds later, e.g. after reporting the deploy
+        if feed:
+            self.feed_json(data_dir, data_files, max_data_samples, collection, **kwargs)
+
+    def set_app(self) -> None:
+        # A container already serving this schema version keeps its documents
+        # across restarts, so reattach to it instead of redeploying and refeeding
+        if not self.manifest.is_empty:
+            try:
+                self.docker = VespaDocker.from_container_name_or_id(self.package.name)
+                self.app = Vespa(url=self.docker.url, port=self.docker.local_port)
+                if self.app.get_application_status() is not None:
+                    return
+            except (ValueError, docker.errors.DockerException, requests.RequestException) as e:
+                # Only a missing or unreachable container, programming errors still raise
+                print(f"Could not reattach to the running application: {e}")
+            self.manifest.reset()
         self.docker = VespaDocker()
         self.app = self.docker.deploy(application_package=self.package)
-        self.feed_json(data_dir, data_files, max_data_samples, **kwargs)
 
-    def set_package(self):
-        self.package = ApplicationPackage(
-        name="hybridsearch",
-        schema=[Schema(
-            name="doc",
-            document=Document(
-                fields=[
-                    Field(name="id", type="string", indexing=["summary"]),
-                    Field(name="title", type="string", indexing=["index", "summary"], index="enable-bm25"),
-                    Field(name="body", type="string", indexing=["index", "summary"], index="enable-bm25", bolding=True),
-                    Field(
-                        name="embedding", type="tensor<float>(x[384])",
-                        indexing=["input title . \" \" . input body", "embed", "index", "attribute"],
-                        ann=HNSW(distance_metric="angular"),
-                        is_document_field=False
-                    )
-                ]
+    def _vector_field(self, name: str, type: str, indexing: list[str], distance_metric: str) -> Field:
+        if self.streaming:
+            # Streaming search scans each group exhaustively, no HNSW graph is built
+            return Field(
+                name=name, type=type,
+                indexing=indexing + ["attribute"],
+                attribute=[f"distance-metric: {distance_metric}"],
+                is_document_field=False
+            )
+        return Field(
+            name=name, type=type,
+            indexing=indexing + ["index", "attribute"],
+            ann=HNSW(distance_metric=distance_metric),
+            is_document_field=False
+        )
+
+    def _embedding_fields(self) -> list[Field]:
+        embedding_input = "input title . \" \" . input body"
+        if not self.binary_quantization:
+            return [self._vector_field(
+                "embedding", "tensor<float>(x[384])", [embedding_input, "embed"], "angular"
+            )]
+        # Only the packed bits are searched, the float vectors are paged
+        # attributes read for the reranked candidates
+        return [
+            Field(
+                name="embedding", type="tensor<float>(x[384])",
+                indexing=[embedding_input, "embed", "attribute"],
+                attribute=["paged", "distance-metric: angular"],
+                is_document_field=False
             ),
-            fieldsets=[
-                FieldSet(name = "default", fields = ["title", "body"])
-            ],
-            rank_profiles=[
-                RankProfile(
-                    name="bm25",
-                    inputs=[("query(q)", "tensor<float>(x[384])")],
-                    functions=[Function(
-                        name="bm25sum", expression="bm25(title) + bm25(body)"
-                    )],
-                    first_phase="bm25sum"
-                ),
+            self._vector_field(
+                "embedding_binary", "tensor<int8>(x[48])",
+                [embedding_input, "embed", "pack_bits"], "hamming"
+            ),
+        ]
+
+    def _rank_profiles(self) -> list[RankProfile]:
+        rank_profiles = [
+            RankProfile(
+                name="bm25",
+                inputs=[("query(q)", "tensor<float>(x[384])")],
+                functions=[Function(
+                    name="bm25sum", expression="bm25(title) + bm25(body)"
+                )],
+                first_phase="bm25sum"
+            ),
+        ]
+        if not self.binary_quantization:
+            return rank_profiles + [
                 RankProfile(
                     name="semantic",
                     inputs=[("query(q)", "tensor<float>(x[384])")],
@@ -120,6 +280,45 @@ class SearchEngineLocal(SearchEngine):
                     )
                 )
             ]
+        return rank_profiles + [
+            RankProfile(
+                name="fusion_binary",
+                inherits="bm25",
+                inputs=[
+                    ("query(q)", "tensor<float>(x[384])"),
+                    ("query(q_binary)", "tensor<int8>(x[48])"),
+                ],
+                functions=[Function(
+                    name="cos_sim",
+                    expression="cosine_similarity(query(q), attribute(embedding), x)"
+                )],
+                first_phase="closeness(field, embedding_binary)",
+                second_phase=SecondPhaseRanking(expression="cos_sim", rerank_count=self.target_hits),
+                global_phase=GlobalPhaseRanking(
+                    expression="bm25sum + cos_sim",
+                    rerank_count=1000
+                )
+            )
+        ]
+
+    def set_package(self):
+        self.package = ApplicationPackage(
+        name="hybridsearch",
+        schema=[Schema(
+            name="doc",
+            mode="streaming" if self.streaming else "index",
+            document=Document(
+                fields=[
+                    Field(name="id", type="string", indexing=["summary"]),
+                    Field(name="title", type="string", indexing=["index", "summary"], index="enable-bm25"),
+                    Field(name="body", type="string", indexing=["index", "summary"], index="enable-bm25", bolding=True),
+                    *self._embedding_fields()
+                ]
+            ),
+            fieldsets=[
+                FieldSet(name = "default", fields = ["title", "body"])
+            ],
+            rank_profiles=self._rank_profiles()
         )],
         components=[Component(id="e5", type="hugging-face-embedder",
             parameters=[
@@ -130,31 +329,72 @@ class SearchEngineLocal(SearchEngine):
     )
 
     def callback(self, response: VespaResponse, id: str) -> None:
+        # Called from the feeding threads
+        with self._feed_lock:
+            self.fed_documents += 1
+            if not response.is_successful():
+                self.failed_documents += 1
         if not response.is_successful():
             print(f"Error while feeding document {id}: {response.get_json()}")
 
+    @property
+    def generation(self) -> int:
+        return self.manifest.generation
+
     def feed_json(
         self,
         data_dir: Path | str,
         data_files: Sequence[str],
         max_data_samples: int | None = None,
+        collection: str | None = None,
         **kwargs
     ) -> None:
-        self.dataset = datasets.load_dataset(
+        if self.streaming:
+            collection = collection or self.default_collection
+        elif collection is not None:
+            raise ValueError("Collections are only supported by streaming search engines.")
+
+        # Segments are append-only, only rows past the last fed one are sent
+        start = self.manifest.fed_until(data_files, collection)
+        self.fed_documents = self.total_documents = start
+        self.failed_documents = 0
+        if max_data_samples and start >= max_data_samples:
+            return
+
+        # A split slice past the end of the corpus is an error in datasets, so the
+        # whole split is loaded (memory-mapped) and the pending rows selected from it
+        dataset = datasets.load_dataset(
             "json",
             data_dir=data_dir,
             data_files=data_files,
-            split=f"train[0:{max_data_samples}]" if max_data_samples else "train",
+            split="train",
             **kwargs
         )
+        stop = len(dataset) if max_data_samples is None else min(max_data_samples, len(dataset))
+        self.total_documents = max(start, stop)
+        if start >= stop:
+            return
+        self.dataset = dataset.select(range(start, stop))
+
         vespa_feed = self.dataset.map(lambda x: {
             "id": x["id"],
             "fields": {
                 "title": x["title"],
                 "body": x["abstract"],
                 "id": x["id"]
-            }
+            },
+            **({"groupname": collection} if collection is not None else {})
         })
         self.app.feed_iterable(
             vespa_feed, schema="doc", namespace="article", callback=self.callback
         )
+        if self.failed_documents:
+            # The segment is not recorded, so the next run feeds the whole range
+            # again; documents already fed are simply overwritten
+            print(
+                f"{self.failed_documents} documents failed to feed, rows {start} to "
+                f"{start + len(self.dataset)} will be fed again on the next run"
+            )
+            return
+        self.manifest.append(data_files, start, start + len(self.dataset), collection)
+        self.manifest.save(self.manifest_path)
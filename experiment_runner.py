@@ -0,0 +1,301 @@
+import importlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+import ir_metrics
+from judgement_store import LEVELS_PROMPT_VERSION, JudgementStore
+
+VERSIONS_DIR = Path(__file__).parent / 'search_engine_versions'
+
+def list_variants():
+    """
+    Returns the names of the search engine variants in search_engine_versions, the backup files and
+    the private helper modules (starting with '_') excluded
+    """
+    return sorted(
+        path.stem for path in VERSIONS_DIR.glob('*.py')
+        if not path.stem.startswith(('BACKUP', '_'))
+    )
+
+def load_queries(path: str | Path = Path('data') / 'queries.json', limit: int | None = None):
+    """
+    path: path of the JSON lines file written by query_generator.ipynb, one article with its 'query' per line
+    limit: integer with the maximum number of queries to load, all of them by default
+
+    Returns a list of dictionaries with the keys 'query_id' (the id of the article the query was
+    generated from, or its line number) and 'query'
+    """
+    queries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            queries.append({'query_id': str(row.get('id', line_number)), 'query': row['query']})
+            if limit is not None and len(queries) == limit:
+                break
+    return queries
+
+def deploy_variant(variant: str,
+                   data_dir: str | Path,
+                   data_files: list,
+                   max_data_samples: int,
+                   feed: bool = True):
+    """
+    variant: name of a module in search_engine_versions
+    data_dir: directory with the article dataset
+    data_files: list with the dataset files to feed
+    max_data_samples: integer with the number of articles to feed
+    feed: boolean to feed the articles, False reuses the documents already in the variant's container,
+        which is restarted by the deployment if it was stopped by stop_variant
+
+    Returns a tuple with the deployed SearchEngine and a dictionary with its feed cost:
+    'deploy_seconds', 'fed_docs' (documents fed successfully), 'feed_seconds' and 'feed_docs_per_second'
+    """
+    module = importlib.import_module(f'search_engine_versions.{variant}')
+    start = perf_counter()
+    # The variants deploy their application package when constructed
+    engine = module.SearchEngine()
+    deploy_seconds = perf_counter() - start
+
+    fed_docs, feed_seconds = 0, np.nan
+    if feed:
+        # The variants pass self.callback to feed_iterable, so the instance attribute
+        # shadows the method and counts the documents actually fed
+        lock = threading.Lock()
+        variant_callback = engine.callback
+        def callback(response, id):
+            nonlocal fed_docs
+            if response.is_successful():
+                with lock:
+                    fed_docs += 1
+            variant_callback(response, id)
+        engine.callback = callback
+
+        start = perf_counter()
+        engine.feed_json(data_dir, data_files, max_data_samples)
+        feed_seconds = perf_counter() - start
+        del engine.callback
+    return engine, {
+        'deploy_seconds': deploy_seconds,
+        'fed_docs': fed_docs if feed else np.nan,
+        'feed_seconds': feed_seconds,
+        'feed_docs_per_second': fed_docs / feed_seconds if feed else np.nan,
+    }
+
+def stop_variant(engine):
+    """
+    engine: SearchEngine returned by deploy_variant
+
+    Stops the Docker container of the variant. Every variant has its own application package,
+    so its own container, and they all listen on the same port; the container is only stopped,
+    not removed, so a later run with feed=False finds its documents again
+    """
+    container = getattr(engine.docker, 'container', None)
+    if container is not None:
+        container.stop()
+
+def run_queries(engine, queries: list, n_hits: int = 10, max_workers: int = 8):
+    """
+    engine: deployed SearchEngine of a variant
+    queries: list of dictionaries returned by load_queries
+    n_hits: integer with the number of hits requested per query
+    max_workers: integer with the number of queries sent at the same time
+
+    Returns a tuple with the run DataFrame (columns 'query_id', 'doc_id', 'rank', 'score'),
+    a DataFrame with the latency of every query in seconds, and the throughput in queries per second
+    """
+    def timed_search(query):
+        start = perf_counter()
+        try:
+            hits = engine.search(query['query'], n_hits=n_hits)
+            if hits.empty:
+                hits = pd.DataFrame(columns=['id', 'relevance'])
+        except Exception as e:
+            # A failed query stays in the latencies but contributes no hits
+            print(f"Error when searching '{query['query']}': {e}")
+            hits = pd.DataFrame(columns=['id', 'relevance'])
+        return query['query_id'], hits, perf_counter() - start
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(timed_search, queries))
+    wall_seconds = perf_counter() - start
+
+    runs = [
+        pd.DataFrame({
+            'query_id': query_id,
+            'doc_id': hits['id'].astype(str).to_numpy(),
+            'rank': np.arange(1, len(hits) + 1),
+            'score': hits['relevance'].to_numpy(dtype=float),
+        })
+        for query_id, hits, _ in results
+    ]
+    latencies = pd.DataFrame(
+        [(query_id, seconds) for query_id, _, seconds in results], columns=['query_id', 'latency_seconds'])
+    return pd.concat(runs, ignore_index=True), latencies, len(queries) / wall_seconds
+
+def load_qrels(store: JudgementStore,
+               judge_model: str = 'llama3-70b-8192',
+               prompt_version: str = LEVELS_PROMPT_VERSION):
+    """
+    store: judgement store filled by the evaluators in query_evaluator_utils
+    judge_model: name of the model whose judgements are used
+    prompt_version: prompt version of the judgements used, the boolean (0 or 1) and the graded (0 to 3)
+        judgements are on different scales, so they are never mixed
+
+    Returns a DataFrame with the columns 'query_id', 'doc_id' and 'relevance'
+    """
+    judgements = store.to_dataframe()
+    judgements = judgements[
+        (judgements['judge_model'] == judge_model) & (judgements['prompt_version'] == prompt_version)]
+    return judgements.rename(columns={'eval': 'relevance'})[['query_id', 'doc_id', 'relevance']]
+
+def judge_runs(runs: pd.DataFrame, queries: list, store: JudgementStore, judge_model: str, data: pd.DataFrame):
+    """
+    runs: DataFrame with the runs of every variant
+    queries: list of dictionaries returned by load_queries
+    store: judgement store, only the pairs missing from it are requested
+    judge_model: name of the model used by the evaluator
+    data: DataFrame with the columns 'id', 'title' and 'abstract' of the fed articles
+    """
+    # Imported here, the evaluator needs the GROQ credentials only when judging
+    from query_evaluator_utils import evaluate_queries_levels
+
+    articles = data.assign(id=data['id'].astype(str)).set_index('id')
+    text = {query['query_id']: query['query'] for query in queries}
+    pairs = runs[['query_id', 'doc_id']].drop_duplicates()
+    pairs = pairs[pairs['doc_id'].isin(articles.index)]
+    evaluate_queries_levels(
+        [
+            {
+                'query_id': query_id,
+                'query': text[query_id],
+                'artigos': [
+                    {'id': doc_id, 'title': articles.at[doc_id, 'title'], 'abstract': articles.at[doc_id, 'abstract']}
+                    for doc_id in group['doc_id']
+                ],
+            }
+            for query_id, group in pairs.groupby('query_id', sort=False)
+        ],
+        model=judge_model,
+        store=store)
+
+def run_experiment(variants: list | None = None,
+                   queries_path: str | Path = Path('data') / 'queries.json',
+                   output_dir: str | Path = Path('data') / 'experiments',
+                   data_dir: str | Path = Path('data'),
+                   data_files: list | None = None,
+                   max_data_samples: int = 10_000,
+                   max_queries: int | None = None,
+                   n_hits: int = 10,
+                   max_workers: int = 8,
+                   feed: bool = True,
+                   judge: bool = False,
+                   judge_model: str = 'llama3-70b-8192',
+                   prompt_version: str = LEVELS_PROMPT_VERSION,
+                   store: JudgementStore | None = None,
+                   k: int = 10):
+    """
+    variants: list with the names of the variants to compare, every variant by default
+    queries_path: path of the query set
+    output_dir: directory where 'runs.parquet' and 'summary.parquet' are written
+    data_dir: directory with the article dataset
+    data_files: list with the dataset files to feed
+    max_data_samples: integer with the number of articles fed to every variant
+    max_queries: integer with the maximum number of queries, all of them by default
+    n_hits: integer with the number of hits requested per query
+    max_workers: integer with the number of queries sent at the same time
+    feed: boolean to feed the articles, False reuses the documents already deployed
+    judge: boolean to request two-step judgements (LEVELS_PROMPT_VERSION) for the hits missing from the store
+    judge_model: name of the model whose judgements are the qrels
+    prompt_version: prompt version of the judgements used as qrels, the two-step graded prompt by default
+    store: judgement store with the qrels
+    k: integer with the cutoff of the quality metrics
+
+    Runs every query against every variant and writes the hits of all runs and one summary row
+    per variant, with its quality metrics and their bootstrap intervals, its p50/p95/p99 query
+    latency, its throughput and its feed cost
+
+    Returns the summary DataFrame
+    """
+    variants = list_variants() if variants is None else variants
+    data_files = ['arxiv-metadata-oai-snapshot.json'] if data_files is None else data_files
+    store = JudgementStore() if store is None else store
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    queries = load_queries(queries_path, max_queries)
+
+    runs, costs = [], []
+    for variant in variants:
+        print(f"Variant {variant}: deploying")
+        engine, cost = deploy_variant(variant, data_dir, data_files, max_data_samples, feed)
+        try:
+            print(f"Variant {variant}: running {len(queries)} queries")
+            run, latencies, throughput = run_queries(engine, queries, n_hits, max_workers)
+        finally:
+            # Frees the port for the container of the next variant
+            stop_variant(engine)
+        seconds = latencies['latency_seconds'].to_numpy()
+        runs.append(run.assign(variant=variant))
+        costs.append({
+            'variant': variant,
+            'latency_p50_ms': np.percentile(seconds, 50) * 1000,
+            'latency_p95_ms': np.percentile(seconds, 95) * 1000,
+            'latency_p99_ms': np.percentile(seconds, 99) * 1000,
+            'throughput_qps': throughput,
+        } | cost)
+    runs = pd.concat(runs, ignore_index=True)
+    runs.to_parquet(output_dir / 'runs.parquet', index=False)
+
+    if judge:
+        from datasets import load_dataset
+        data = load_dataset(
+            'json', data_dir=str(data_dir), data_files=data_files, split=f'train[0:{max_data_samples}]'
+        ).select_columns(['id', 'title', 'abstract']).to_pandas()
+        judge_runs(runs, queries, store, judge_model, data)
+
+    # Every query counts for every variant, a query that failed or returned nothing scores 0
+    metrics = ir_metrics.per_query_metrics(
+        runs, load_qrels(store, judge_model, prompt_version), k=k,
+        query_ids=[query['query_id'] for query in queries])
+    summary = ir_metrics.summarize(metrics).merge(pd.DataFrame(costs), on='variant')
+    summary.to_parquet(output_dir / 'summary.parquet', index=False)
+    return summary
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the search engine variants on the query set')
+    parser.add_argument('--variants', nargs='*', default=None, help='variants to run, all of them by default')
+    parser.add_argument('--queries', default=str(Path('data') / 'queries.json'))
+    parser.add_argument('--output-dir', default=str(Path('data') / 'experiments'))
+    parser.add_argument('--max-data-samples', type=int, default=10_000)
+    parser.add_argument('--max-queries', type=int, default=None)
+    parser.add_argument('--n-hits', type=int, default=10)
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--no-feed', action='store_true', help='reuse the documents already fed')
+    parser.add_argument('--judge', action='store_true', help='judge the hits missing from the store')
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    summary = run_experiment(
+        variants=args.variants,
+        queries_path=args.queries,
+        output_dir=args.output_dir,
+        max_data_samples=args.max_data_samples,
+        max_queries=args.max_queries,
+        n_hits=args.n_hits,
+        max_workers=args.max_workers,
+        feed=not args.no_feed,
+        judge=args.judge,
+        k=args.k,
+    )
+    print(summary.to_string(index=False))
@@ -0,0 +1,212 @@
+import numpy as np
+import pandas as pd
+
+
+def per_query_metrics(run: pd.DataFrame,
+                      qrels: pd.DataFrame,
+                      k: int = 10,
+                      relevant_threshold: int = 2,
+                      query_ids: list | None = None):
+    """
+    run: DataFrame with the columns 'query_id', 'doc_id' and 'rank', and optionally 'variant'
+        to evaluate several search engine variants at once
+    qrels: DataFrame with the columns 'query_id', 'doc_id' and 'relevance', the graded 0 to 3 judgements
+    k: integer with the cutoff of nDCG, recall and precision
+    relevant_threshold: integer with the lowest relevance counted as relevant by the binary metrics
+        (MRR, recall, MAP and precision), nDCG uses the graded relevance
+    query_ids: list with the ids of the queries every variant is evaluated on, besides the queries in the run,
+        the queries in qrels by default
+
+    Documents missing from qrels count as not relevant. Every evaluated query gets a row for every
+    variant, a query without hits in a variant (failed or empty) scoring 0 instead of being left out.
+    Metrics that are undefined for a query, such as recall for a query without relevant documents, are NaN
+
+    Returns a DataFrame with one row per variant and query, and the columns 'ndcg@k', 'mrr',
+    'recall@k', 'map' and 'precision@k'
+    """
+    keys = ['variant', 'query_id'] if 'variant' in run.columns else ['query_id']
+    qrels = qrels[['query_id', 'doc_id', 'relevance']]
+
+    run = run[keys + ['doc_id', 'rank']].merge(qrels, on=['query_id', 'doc_id'], how='left')
+    run = run.sort_values(keys + ['rank'], kind='stable')
+    # Ranks are renumbered from 1, so gaps and 0-based runs give the same metrics
+    ranks = run.groupby(keys, sort=False).cumcount().to_numpy() + 1
+    relevance = run['relevance'].fillna(0).to_numpy(dtype=float)
+    relevant = relevance >= relevant_threshold
+    in_cutoff = ranks <= k
+
+    run = run[keys].assign(
+        dcg=np.where(in_cutoff, (2 ** relevance - 1) / np.log2(ranks + 1), 0.0),
+        hits=relevant & in_cutoff,
+        reciprocal_rank=np.where(relevant, 1 / ranks, 0.0),
+        relevant=relevant.astype(int),
+    )
+    # Precision at the rank of every relevant document, summed up for the average precision
+    run['precision_at_relevant'] = np.where(
+        relevant, run.groupby(keys, sort=False)['relevant'].cumsum().to_numpy() / ranks, 0.0)
+    metrics = run.groupby(keys, sort=False).agg(
+        dcg=('dcg', 'sum'),
+        hits=('hits', 'sum'),
+        mrr=('reciprocal_rank', 'max'),
+        precision_sum=('precision_at_relevant', 'sum'),
+    )
+
+    # One row per variant and evaluated query, the queries without hits get no gain at all
+    query_ids = pd.Index(qrels['query_id'].unique() if query_ids is None else query_ids, name='query_id')
+    if 'variant' in keys:
+        index = pd.MultiIndex.from_product([run['variant'].unique(), query_ids], names=keys)
+    else:
+        index = query_ids
+    metrics = metrics.reindex(metrics.index.union(index, sort=False), fill_value=0).reset_index()
+
+    ideal = qrels.sort_values(['query_id', 'relevance'], ascending=[True, False], kind='stable')
+    ideal_ranks = ideal.groupby('query_id', sort=False).cumcount().to_numpy() + 1
+    ideal_gains = np.where(
+        ideal_ranks <= k, (2 ** ideal['relevance'].to_numpy(dtype=float) - 1) / np.log2(ideal_ranks + 1), 0.0)
+    idcg = pd.Series(ideal_gains, index=ideal.index).groupby(ideal['query_id']).sum()
+    n_relevant = (qrels['relevance'] >= relevant_threshold).groupby(qrels['query_id']).sum()
+
+    idcg = metrics['query_id'].map(idcg).replace(0, np.nan)
+    n_relevant = metrics['query_id'].map(n_relevant).replace(0, np.nan)
+    metrics[f'ndcg@{k}'] = metrics['dcg'] / idcg
+    metrics[f'recall@{k}'] = metrics['hits'] / n_relevant
+    metrics['map'] = metrics['precision_sum'] / n_relevant
+    metrics[f'precision@{k}'] = metrics['hits'] / k
+    return metrics[keys + [f'ndcg@{k}', 'mrr', f'recall@{k}', 'map', f'precision@{k}']]
+
+def _metric_columns(metrics: pd.DataFrame):
+    return [column for column in metrics.columns if column not in ('variant', 'query_id')]
+
+def bootstrap_ci(values: np.ndarray,
+                 n_resamples: int = 1000,
+                 confidence: float = 0.95,
+                 seed: int | None = 0):
+    """
+    values: array with one metric value per query, NaN values are ignored
+    n_resamples: integer with the number of bootstrap resamples of the queries
+    confidence: float with the confidence level of the interval
+    seed: seed of the random generator, so the intervals are reproducible
+
+    Returns a tuple with the lower and upper bounds of the percentile bootstrap interval of the mean
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.nan, np.nan
+    rng = np.random.default_rng(seed)
+    # All resamples at once, as a (n_resamples, n_queries) matrix of indices
+    means = values[rng.integers(0, len(values), size=(n_resamples, len(values)))].mean(axis=1)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(means, [alpha, 1 - alpha])
+    return low, high
+
+def summarize(metrics: pd.DataFrame,
+              n_resamples: int = 1000,
+              confidence: float = 0.95,
+              seed: int | None = 0):
+    """
+    metrics: DataFrame returned by per_query_metrics
+    n_resamples: integer with the number of bootstrap resamples of the queries
+    confidence: float with the confidence level of the intervals
+    seed: seed of the random generator
+
+    Returns a DataFrame with one row per variant and, for every metric, its mean over the queries
+    and the columns '<metric>_low' and '<metric>_high' with the bounds of its bootstrap interval
+    """
+    if 'variant' not in metrics.columns:
+        metrics = metrics.assign(variant='run')
+    rows = []
+    for variant, group in metrics.groupby('variant', sort=False):
+        row = {'variant': variant, 'queries': group['query_id'].nunique()}
+        for column in _metric_columns(metrics):
+            low, high = bootstrap_ci(group[column].to_numpy(), n_resamples, confidence, seed)
+            row |= {column: group[column].mean(), f'{column}_low': low, f'{column}_high': high}
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def paired_test(a: np.ndarray, b: np.ndarray, n_resamples: int = 10_000, seed: int | None = 0):
+    """
+    a: array with one metric value per query for the first variant
+    b: array with the values of the same queries, in the same order, for the second variant
+    n_resamples: integer with the number of random sign flips
+    seed: seed of the random generator
+
+    Paired randomization test: under the null hypothesis the sign of every per-query
+    difference is arbitrary. Queries with a NaN value in either variant are ignored
+
+    Returns a tuple with the mean difference b - a and its two-sided p-value
+    """
+    differences = np.asarray(b, dtype=float) - np.asarray(a, dtype=float)
+    differences = differences[~np.isnan(differences)]
+    if len(differences) == 0:
+        return np.nan, np.nan
+    observed = differences.mean()
+    rng = np.random.default_rng(seed)
+    signs = rng.choice(np.array([-1.0, 1.0]), size=(n_resamples, len(differences)))
+    flipped = np.abs((signs * differences).mean(axis=1))
+    # The observed assignment counts as one of the resamples, so p is never 0
+    p_value = (np.sum(flipped >= abs(observed) - 1e-12) + 1) / (n_resamples + 1)
+    return observed, p_value
+
+def compare_variants(metrics: pd.DataFrame,
+                     baseline: str,
+                     n_resamples: int = 10_000,
+                     seed: int | None = 0,
+                     chunk_size: int = 1000):
+    """
+    metrics: DataFrame returned by per_query_metrics for a run with a 'variant' column
+    baseline: name of the variant every other variant is compared to
+    n_resamples: integer with the number of random sign flips of the paired tests
+    seed: seed of the random generator
+    chunk_size: integer with the number of sign flips drawn at once, bounding the memory used
+
+    Paired randomization tests of every variant against the baseline, as in paired_test. The sign
+    flips of a metric are drawn once and shared by every variant, so all the null distributions come
+    from one (resamples x queries) @ (queries x variants) product. Queries with a NaN value in the
+    baseline or the variant are ignored for that variant
+
+    Returns a DataFrame with one row per variant and metric, and the columns 'variant', 'metric',
+    'baseline', 'difference' (variant minus baseline) and 'p_value'
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for column in _metric_columns(metrics):
+        table = metrics.pivot(index='query_id', columns='variant', values=column)
+        variants = [variant for variant in table.columns if variant != baseline]
+        # (queries x variants) differences, the NaN ones zeroed and left out of the counts
+        differences = table[variants].to_numpy(dtype=float) - table[[baseline]].to_numpy(dtype=float)
+        valid = ~np.isnan(differences)
+        differences = np.where(valid, differences, 0.0)
+        counts = valid.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            observed = differences.sum(axis=0) / counts
+            extreme = np.zeros(len(variants))
+            for start in range(0, n_resamples, chunk_size):
+                signs = rng.choice(np.array([-1.0, 1.0]), size=(min(chunk_size, n_resamples - start), len(table)))
+                flipped = np.abs(signs @ differences) / counts
+                extreme += np.sum(flipped >= np.abs(observed) - 1e-12, axis=0)
+        # The observed assignment counts as one of the resamples, so p is never 0
+        p_values = np.where(counts > 0, (extreme + 1) / (n_resamples + 1), np.nan)
+        for variant, difference, p_value in zip(variants, observed, p_values):
+            rows.append({
+                'variant': variant,
+                'metric': column,
+                'baseline': baseline,
+                'difference': difference,
+                'p_value': p_value,
+            })
+    return pd.DataFrame(rows)
+
+def results_to_run(results: pd.DataFrame):
+    """
+    results: DataFrame in the layout of full_results.csv, with the columns 'id' and 'query_id',
+        one block of hits per query in rank order, and optionally 'variant'
+
+    Returns a run DataFrame with the columns 'query_id', 'doc_id' and 'rank' (and 'variant'),
+    the rank being the position of the hit in its query's block
+    """
+    keys = ['variant', 'query_id'] if 'variant' in results.columns else ['query_id']
+    run = results[keys].copy()
+    run['doc_id'] = results['id'].astype(str)
+    run['rank'] = results.groupby(keys, sort=False).cumcount() + 1
+    return run
@@ -0,0 +1,103 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+
+# Bump these whenever the judgement prompts in query_evaluator_utils change, judgements
+# stored for an older prompt are then requested again instead of being reused
+LEVELS_PROMPT_VERSION = 'levels-v1'
+SINGLE_PASS_PROMPT_VERSION = 'levels-single-pass-v1'
+LISTWISE_PROMPT_VERSION = 'levels-listwise-v1'
+BOOLEAN_PROMPT_VERSION = 'boolean-v1'
+
+class JudgementStore:
+    """
+    Relevance judgements persisted in SQLite, keyed by query id, document id, judge model and prompt version
+
+    Search variants mostly return the same documents for a query, so a judgement requested once
+    is reused by every later evaluation with the same judge model and prompt
+    """
+
+    def __init__(self, path: str | Path = Path('data') / 'judgements.sqlite') -> None:
+        """
+        path: path of the SQLite database, created with its parent directory when missing
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS judgements ("
+                "query_id TEXT, doc_id TEXT, judge_model TEXT, prompt_version TEXT, "
+                "eval INTEGER, explanation TEXT, created REAL, "
+                "PRIMARY KEY (query_id, doc_id, judge_model, prompt_version))"
+            )
+
+    def get(self, query_id: str, doc_id: str, judge_model: str, prompt_version: str):
+        """
+        Returns a dictionary with the keys 'eval' and 'explanation', or None when the pair was never judged
+        """
+        return self.get_many(query_id, [doc_id], judge_model, prompt_version).get(str(doc_id))
+
+    def get_many(self, query_id: str, doc_ids: list, judge_model: str, prompt_version: str):
+        """
+        query_id: id of the query the documents were judged against
+        doc_ids: list with the ids of the documents
+        judge_model: name of the model that gave the judgements
+        prompt_version: version of the judgement prompt
+
+        Returns a dictionary mapping the ids of the already judged documents to dictionaries
+        with the keys 'eval' and 'explanation'
+        """
+        doc_ids = [str(doc_id) for doc_id in doc_ids]
+        judgements = {}
+        with self._lock:
+            # Bounded batches stay under SQLite's limit of host parameters
+            for start in range(0, len(doc_ids), 500):
+                batch = doc_ids[start:start + 500]
+                rows = self._connection.execute(
+                    "SELECT doc_id, eval, explanation FROM judgements "
+                    "WHERE query_id = ? AND judge_model = ? AND prompt_version = ? "
+                    f"AND doc_id IN ({', '.join('?' * len(batch))})",
+                    (str(query_id), judge_model, prompt_version, *batch)
+                ).fetchall()
+                for doc_id, eval, explanation in rows:
+                    judgements[doc_id] = {'eval': eval, 'explanation': explanation}
+        return judgements
+
+    def missing(self, query_id: str, doc_ids: list, judge_model: str, prompt_version: str):
+        """
+        Returns the ids in doc_ids that have no judgement for the query, judge model and prompt version yet
+        """
+        judged = self.get_many(query_id, doc_ids, judge_model, prompt_version)
+        return [doc_id for doc_id in doc_ids if str(doc_id) not in judged]
+
+    def put(self,
+            query_id: str,
+            doc_id: str,
+            judge_model: str,
+            prompt_version: str,
+            eval: int,
+            explanation: str | None = None) -> None:
+        """
+        Stores a judgement, replacing any earlier one with the same key
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO judgements VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(query_id), str(doc_id), judge_model, prompt_version, int(eval), explanation, time.time())
+            )
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Returns every stored judgement as a DataFrame, one row per judgement
+        """
+        with self._lock:
+            return pd.read_sql_query("SELECT * FROM judgements", self._connection)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM judgements").fetchone()[0]
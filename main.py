@@ -1,4 +1,10 @@
+import logging
+
 from ArticLE import App
 
+# Shows the token usage logged by the LLM, without the INFO logs of the libraries
+logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+logging.getLogger("ArticLE").setLevel(logging.INFO)
+
 app = App(on_cloud=False)
 app.run()
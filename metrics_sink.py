@@ -0,0 +1,297 @@
+'''
+Destinos (sinks) para salvar as métricas das avaliações localmente, sem
+depender de rede, e exportá-las em lote para o Google Sheets
+'''
+
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import pandas as pd
+
+
+class MetricsSink(ABC):
+    '''
+    Interface dos destinos de métricas. Cada tipo de métrica é uma tabela
+    (ou página) à qual linhas são apenas adicionadas
+    '''
+    @abstractmethod
+    def write(self, type_of_metric:str, data:pd.DataFrame) -> None:
+        '''
+        Função para adicionar linhas de métricas
+
+        Parâmetros
+        ----------
+        type_of_metric : str
+            Tipo de métrica (nome da tabela)
+        data : pd.DataFrame
+            DataFrame com as linhas que serão adicionadas
+        '''
+
+    @abstractmethod
+    def read(self, type_of_metric:str) -> pd.DataFrame:
+        '''
+        Função para ler todas as linhas de um tipo de métrica, na ordem em
+        que foram escritas
+
+        Parâmetros
+        ----------
+        type_of_metric : str
+            Tipo de métrica (nome da tabela)
+
+        Retorna
+        -------
+        pd.DataFrame
+            DataFrame com as linhas salvas, vazio se não houver nenhuma
+        '''
+
+    def flush(self) -> None:
+        '''
+        Função para garantir que todas as escritas foram persistidas
+        '''
+
+    def close(self) -> None:
+        '''
+        Função para persistir as escritas pendentes e liberar os recursos
+        '''
+        self.flush()
+
+    def __enter__(self) -> 'MetricsSink':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class InMemorySink(MetricsSink):
+    '''
+    Destino em memória, para testes e execuções que não precisam persistir
+    as métricas
+    '''
+    def __init__(self) -> None:
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def write(self, type_of_metric:str, data:pd.DataFrame) -> None:
+        with self._lock:
+            self._tables.setdefault(type_of_metric, []).append(data.copy())
+
+    def read(self, type_of_metric:str) -> pd.DataFrame:
+        with self._lock:
+            parts = list(self._tables.get(type_of_metric, []))
+        return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+
+class SQLiteSink(MetricsSink):
+    '''
+    Destino em um banco SQLite local, uma tabela por tipo de métrica
+
+    Parâmetros
+    ----------
+    path : str | Path
+        Caminho do banco. O padrão é 'data/metrics.sqlite'
+    '''
+    def __init__(self, path:str | Path=Path('data') / 'metrics.sqlite') -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+
+    def write(self, type_of_metric:str, data:pd.DataFrame) -> None:
+        with self._lock, self._connection:
+            data.to_sql(type_of_metric, self._connection, if_exists='append', index=False)
+
+    def read(self, type_of_metric:str) -> pd.DataFrame:
+        with self._lock:
+            exists = self._connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (type_of_metric,)
+            ).fetchone()
+            if exists is None:
+                return pd.DataFrame()
+            return pd.read_sql_query(
+                f'SELECT * FROM "{type_of_metric}" ORDER BY rowid', self._connection
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class ParquetSink(MetricsSink):
+    '''
+    Destino em arquivos Parquet locais. Cada escrita cria um novo arquivo na
+    pasta do tipo de métrica, então nenhuma escrita reescreve as anteriores
+
+    Parâmetros
+    ----------
+    directory : str | Path
+        Pasta dos arquivos. O padrão é 'data/metrics'
+    '''
+    def __init__(self, directory:str | Path=Path('data') / 'metrics') -> None:
+        self.directory = Path(directory)
+
+    def write(self, type_of_metric:str, data:pd.DataFrame) -> None:
+        folder = self.directory / type_of_metric
+        folder.mkdir(parents=True, exist_ok=True)
+        # O prefixo com o tempo mantém os arquivos na ordem das escritas
+        name = f"part-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.parquet"
+        data.to_parquet(folder / name, index=False)
+
+    def read(self, type_of_metric:str) -> pd.DataFrame:
+        parts = sorted((self.directory / type_of_metric).glob('part-*.parquet'))
+        if not parts:
+            return pd.DataFrame()
+        return pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+
+
+class AsyncSink(MetricsSink):
+    '''
+    Envoltório que faz as escritas de outro destino em uma thread separada,
+    para que salvar métricas nunca bloqueie o loop de avaliação
+
+    Parâmetros
+    ----------
+    sink : MetricsSink
+        Destino que recebe as escritas
+    max_pending : int
+        Número máximo de escritas na fila. Com a fila cheia, novas escritas
+        são descartadas (e contadas em `dropped`) em vez de bloquear
+    '''
+    def __init__(self, sink:MetricsSink, max_pending:int=10_000) -> None:
+        self.sink = sink
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self.sink.write(*item)
+            except Exception as e:
+                print(f"Erro ao salvar métricas: {e}")
+            finally:
+                self._queue.task_done()
+
+    def write(self, type_of_metric:str, data:pd.DataFrame) -> None:
+        try:
+            self._queue.put_nowait((type_of_metric, data.copy()))
+        except queue.Full:
+            self.dropped += 1
+            print(f"Fila de métricas cheia, {self.dropped} escritas descartadas")
+
+    def read(self, type_of_metric:str) -> pd.DataFrame:
+        # Lê o que já foi persistido, sem esperar a fila
+        return self.sink.read(type_of_metric)
+
+    def flush(self) -> None:
+        self._queue.join()
+        self.sink.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self.sink.close()
+
+
+class SheetsExporter():
+    '''
+    Exportador opcional que sincroniza um destino local com o Google Sheets
+    em lote, enviando apenas as linhas ainda não exportadas. As linhas já
+    exportadas são contadas em memória, então um novo exportador reenvia
+    tudo
+
+    Parâmetros
+    ----------
+    sink : MetricsSink
+        Destino local de onde as métricas são lidas
+    save_metrics : SaveMetrics | None
+        Conexão com o Google Sheets. Se None, cria uma nova
+    '''
+    def __init__(self, sink:MetricsSink, save_metrics=None) -> None:
+        if save_metrics is None:
+            # Importado aqui para que as dependências do Google sejam opcionais
+            from sheets_connection import SaveMetrics
+            save_metrics = SaveMetrics()
+        self.sink = sink
+        self.save_metrics = save_metrics
+        self._exported = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def export(self, types_of_metric:list[str]) -> int:
+        '''
+        Função para enviar ao Google Sheets as linhas novas dos tipos de
+        métrica, com um único `values().append` por página
+
+        Parâmetros
+        ----------
+        types_of_metric : list[str]
+            Tipos de métrica (páginas) a exportar
+
+        Retorna
+        -------
+        int
+            Número de linhas exportadas
+        '''
+        with self._lock:
+            exported = 0
+            for type_of_metric in types_of_metric:
+                data = self.sink.read(type_of_metric)
+                new = data.iloc[self._exported.get(type_of_metric, 0):]
+                if len(new) > 0:
+                    self.save_metrics.append_metrics(type_of_metric, new)
+                    # Um SaveMetrics com buffered=True só envia as linhas no flush
+                    self.save_metrics.flush()
+                    exported += len(new)
+                # Só conta como exportado depois que o append deu certo
+                self._exported[type_of_metric] = len(data)
+            return exported
+
+    def start(self, types_of_metric:list[str], interval:float=60.0) -> None:
+        '''
+        Função para exportar periodicamente em uma thread separada
+
+        Parâmetros
+        ----------
+        types_of_metric : list[str]
+            Tipos de métrica (páginas) a exportar
+        interval : float
+            Segundos entre as exportações
+        '''
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.export(types_of_metric)
+                except Exception as e:
+                    print(f"Erro ao exportar métricas para o Google Sheets: {e}")
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=loop, daemon=True)
+        self._thread.start()
+
+    def stop(self, types_of_metric:list[str] | None = None) -> None:
+        '''
+        Função para parar a exportação periódica, fazendo uma última
+        exportação dos tipos de métrica informados
+
+        Parâmetros
+        ----------
+        types_of_metric : list[str] | None
+            Tipos de métrica a exportar uma última vez. Se None, não exporta
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if types_of_metric:
+            self.export(types_of_metric)
@@ -1,14 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from time import monotonic
 from groq import Groq
-from time import sleep
 from tqdm import tqdm
 import json
 
 from AuthKey import GROQ_API_KEY
+from ArticLE.search.budget import PromptBudget
+from ArticLE.search.cache import CompletionCache
+from ArticLE.search.rate_limit import RateLimitedClient
+from judgement_store import (
+    BOOLEAN_PROMPT_VERSION,
+    LEVELS_PROMPT_VERSION,
+    LISTWISE_PROMPT_VERSION,
+    SINGLE_PASS_PROMPT_VERSION,
+    JudgementStore,
+)
 
-client = Groq(
-    api_key=GROQ_API_KEY,
+# Free tier limits of the GROQ API for llama3-70b-8192
+client = RateLimitedClient(
+    Groq(api_key=GROQ_API_KEY, max_retries=0),
+    requests_per_minute=30,
+    tokens_per_minute=6000,
+    max_concurrency=4,
 )
 
+# Shared with the app's LLM, so identical prompts are only ever paid for once
+cache = CompletionCache()
+
+def get_levels_prompt_version(mode: str):
+    """
+    mode: 'two_step' for the initial response followed by the feedback, or 'single_pass' for a single JSON judgement
+
+    Returns the prompt version the judgements of that mode are stored with
+    """
+    match mode:
+        case 'two_step':
+            return LEVELS_PROMPT_VERSION
+        case 'single_pass':
+            return SINGLE_PASS_PROMPT_VERSION
+        case _:
+            raise ValueError(f"Unknown judging mode: {mode}")
+
+def get_doc_id(artigo: dict):
+    """
+    artigo: dictionary with the key 'title' and optionally 'id'
+
+    Returns the id of the article in the judgement store, its title when it has no id
+    """
+    return str(artigo.get('id', artigo['title']))
+
+def create_completion(messages: list, model: str, max_tokens: int, refresh: bool = False, json_mode: bool = False):
+    """
+    messages: list of dictionaries with the keys 'role' and 'content'
+    model: string with a valid model name from the GROQ API
+    max_tokens: integer with the maximum number of tokens to be used in the completion
+    refresh: boolean to skip the cached completion, used when a cached output could not be parsed
+    json_mode: boolean to constrain the completion to a JSON object, the prompt must ask for JSON
+
+    Returns a string with the content of the completion, served from the completion cache when possible
+    """
+    if not refresh:
+        completion = cache.get(model, max_tokens, messages)
+        if completion is not None:
+            return completion
+    response = client.create(
+        model=model,
+        n=1,
+        messages=messages,
+        max_tokens = max_tokens,
+        **({'response_format': {'type': 'json_object'}} if json_mode else {}))
+    completion = response.choices[0].message.content
+    cache.set(model, max_tokens, messages, completion)
+    return completion
+
 def get_initial_response(prompt: str, model: str = 'llama3-70b-8192', max_tokens: int = 1000):
     """
     prompt: string with the prompt to be used in the completion
@@ -17,13 +82,9 @@ def get_initial_response(prompt: str, model: str = 'llama3-70b-8192', max_tokens
 
     Returns a string with the initial evaluation (0, 1, 2, or 3) given by the LLM
     """
-    while True:
-        try:
-            response = client.chat.completions.create(
-                model=model,
-                n=1,
-                messages=[
-                    {"role": "user", "content": "You are an assistant AI specialized in evaluating articles based on a given query. \
+    response = create_completion(
+        messages=[
+            {"role": "user", "content": "You are an assistant AI specialized in evaluating articles based on a given query. \
                     Your goal is to evaluate an article's relevance based on a search query. You should return only one of the following integers: 0, 1, 2, or 3. \
                     0 means that the article has absolutely no relevance for the query. \
                     1 means that the article is only very slightly relevant to the query, sharing at most a similar topic. \
@@ -33,32 +94,26 @@ def get_initial_response(prompt: str, model: str = 'llama3-70b-8192', max_tokens
                     Read the following article, named 'Increased lifespan on athletes', with the following content: \n Sports practicing has been shown to increase lifespawn and health. \n\
                     Evaluate how relevant the article is to the following query: Positive health impacts on volleyball practice. \n \
                     Response: 2"},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens = max_tokens)
-            return response.choices[0].message.content.lower()
-        except Exception as e:
-            print("Error when generating initial response:", e)
-            sleep(30)
-            continue
+            {"role": "user", "content": prompt}
+        ],
+        model=model,
+        max_tokens=max_tokens)
+    return response.lower()
 
-def get_feedback(artigo: dict, query: str, response: str, model: str = 'llama3-70b-8192', max_tokens: int = 1000):
+def get_feedback(artigo: dict, query: str, response: str, model: str = 'llama3-70b-8192', max_tokens: int = 1000, refresh: bool = False):
     """
     artigo: dictionary with the keys 'title' and 'abstract'
     query: string with the query that the article will be evaluated against
     response: string with the initial response given by the LLM
     model: string with a valid model name from the GROQ API
     max_tokens: integer with the maximum number of tokens to be used in the completion
+    refresh: boolean to skip the cached completion
 
     Returns a string containing the revised evaluation and the explanation given by the LLM
     """
-    while True:
-        try:
-            feedback = client.chat.completions.create(
-                model=model,
-                n=1,
-                messages=[
-                    {"role": "user", "content": f"You are an assistant AI specialized in reevaluating articles based on a given query. \
+    feedback = create_completion(
+        messages=[
+            {"role": "user", "content": f"You are an assistant AI specialized in reevaluating articles based on a given query. \
                     Your goal is to reevaluate the classification given by the previous assistant, about an article's relevance based on a search query. The relevance levels are: \
                     0 means that the article has absolutely no relevance for the query. \
                     1 means that the article is only very slightly relevant to the query, sharing at most a similar topic. \
@@ -71,81 +126,504 @@ def get_feedback(artigo: dict, query: str, response: str, model: str = 'llama3-7
                     Try to avoid extreme answers like 0 or 3 unless you are sure that is the case. \
                     Write your answer in the following json structure, where 'explanation' represents your reasoning, and 'eval' represents your evaluation: \n \
                     {{\"explanation\": \"your explanation\", \"eval\": \"your evaluation, needs to be exactly 0, 1, 2, or 3.\"\}}"}
-                ],
-                max_tokens = max_tokens)
-            return feedback.choices[0].message.content.lower()
-        except Exception as e:
-            print("Error when generating feedback:", e)
-            sleep(30)
-            continue
+        ],
+        model=model,
+        max_tokens=max_tokens,
+        refresh=refresh)
+    return feedback.lower()
 
-def get_feedback_json(artigo: dict, query: str, response: str, model: str = 'llama3-70b-8192', max_tokens: int = 1000):
+def get_feedback_json(artigo: dict, query: str, response: str, model: str = 'llama3-70b-8192', max_tokens: int = 1000, max_retries: int = 3):
     """
     artigo: dictionary with the keys 'title' and 'abstract'
     query: string with the query that the article will be evaluated against
     response: string with the initial response given by the LLM
     model: string with a valid model name from the GROQ API
     max_tokens: integer with the maximum number of tokens to be used in the completion
+    max_retries: integer with the number of new requests after an invalid feedback
 
-    Converts the string given by the get_feedback function into a dictionary, and checks if the 'eval' key is a valid integer
+    Converts the string given by the get_feedback function into a dictionary, and checks if the 'eval' key is a valid integer.
+    Only invalid feedbacks are retried, API errors are raised to the caller
 
-    Returns a dictionary with the keys 'explanation' and 'eval' where 'eval' is an integer from 0 to 3
+    Returns a dictionary with the keys 'explanation' and 'eval' where 'eval' is an integer from 0 to 3,
+    raises a ValueError when every attempt returned an invalid feedback
     """
-    while True:
+    refresh = False
+    for attempt in range(max_retries + 1):
+        feedback = get_feedback(artigo, query, response, model, max_tokens, refresh)
         try:
-            feedback = get_feedback(artigo, query, response, model, max_tokens)
             dict = json.loads(feedback)
             dict['eval'] = int(dict['eval'])
             if dict['eval'] in [0, 1, 2, 3]:
                 return dict
             else:
-                raise Exception("Invalid evaluation: ", dict['eval'])
-        except Exception as e:
-            print("Error when parsing feedback:", e)
+                raise ValueError(f"Invalid evaluation: {dict['eval']}")
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+            print(f"Error when parsing feedback (attempt {attempt + 1} of {max_retries + 1}):", e)
+            # Never retry against the same unparsable cached completion
+            refresh = True
+    raise ValueError(f"No valid feedback for the article '{artigo['title']}' after {max_retries + 1} attempts")
+
+def parse_judgement(judgement: str):
+    """
+    judgement: string with the JSON object returned by the LLM
+
+    Returns a dictionary with the keys 'explanation' and 'eval' where 'eval' is an integer from 0 to 3,
+    raises a ValueError when the judgement is not valid
+    """
+    try:
+        parsed = json.loads(judgement)
+        evaluation = int(parsed['eval'])
+        explanation = str(parsed['explanation'])
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid judgement: {judgement!r}") from e
+    if evaluation not in [0, 1, 2, 3]:
+        raise ValueError(f"Invalid evaluation: {evaluation}")
+    return {'explanation': explanation, 'eval': evaluation}
+
+def get_judgement_json(artigo: dict, query: str, model: str = 'llama3-70b-8192', max_tokens: int = 1000, max_retries: int = 3):
+    """
+    artigo: dictionary with the keys 'title' and 'abstract'
+    query: string with the query that the article will be evaluated against
+    model: string with a valid model name from the GROQ API
+    max_tokens: integer with the maximum number of tokens to be used in the completion
+    max_retries: integer with the number of new requests after an invalid judgement
+
+    Asks for the explanation and the evaluation together in a single JSON mode request,
+    instead of the initial response followed by the feedback
+
+    Returns a dictionary with the keys 'explanation' and 'eval' where 'eval' is an integer from 0 to 3,
+    raises a ValueError when every attempt returned an invalid judgement
+    """
+    refresh = False
+    for attempt in range(max_retries + 1):
+        judgement = create_completion(
+            messages=[
+                {"role": "system", "content": "You are an assistant AI specialized in evaluating articles based on a given query. \
+                    Your goal is to evaluate an article's relevance based on a search query. The relevance levels are: \
+                    0 means that the article has absolutely no relevance for the query. \
+                    1 means that the article is only very slightly relevant to the query, sharing at most a similar topic. \
+                    2 means that the article is relevant to the query, sharing many similarities, but it's still not entirely relevant to the query. \
+                    3 means that the article is completely relevant to the query. \
+                    Try to avoid extreme answers like 0 or 3 unless you are sure that is the case. \
+                    Write your answer in the following json structure, where 'explanation' represents your reasoning, and 'eval' represents your evaluation: \n \
+                    {\"explanation\": \"your explanation\", \"eval\": \"your evaluation, needs to be exactly 0, 1, 2, or 3.\"}"},
+                {"role": "user", "content": f"Read the following article, named '{artigo['title']}', with the following content: \n {artigo['abstract']} \n \
+                    Evaluate how relevant the article is to the following query: {query} \n"}
+            ],
+            model=model,
+            max_tokens=max_tokens,
+            refresh=refresh,
+            json_mode=True)
+        try:
+            return parse_judgement(judgement.lower())
+        except ValueError as e:
+            print(f"Error when parsing judgement (attempt {attempt + 1} of {max_retries + 1}):", e)
+            # Never retry against the same unparsable cached completion
+            refresh = True
+    raise ValueError(f"No valid judgement for the article '{artigo['title']}' after {max_retries + 1} attempts")
+
+def evaluate_article_levels(artigo: dict,
+                      query: str,
+                      model: str = 'llama3-70b-8192',
+                      max_tokens: int = 1000,
+                      store: JudgementStore | None = None,
+                      query_id: str | None = None,
+                      mode: str = 'two_step'):
+    """
+    artigo: dictionary with the keys 'title' and 'abstract', and optionally 'id'
+    query: string with the query that the article will be evaluated against
+    model: string with a valid model name from the GROQ API
+    max_tokens: integer with the maximum number of tokens to be used in the completion
+    store: judgement store to reuse earlier judgements from and save the new one to
+    query_id: id of the query in the judgement store, the query itself by default
+    mode: 'two_step' runs both steps of the judgement (initial response and feedback),
+        'single_pass' asks for the explanation and the evaluation in a single request
+
+    Judges a single article, unless the store already has a judgement for it in the same mode
+
+    Returns a dictionary with the keys 'title', 'abstract', 'eval' and 'explanation'
+    """
+    query_id = query if query_id is None else query_id
+    prompt_version = get_levels_prompt_version(mode)
+    if store is not None:
+        judgement = store.get(query_id, get_doc_id(artigo), model, prompt_version)
+        if judgement is not None:
+            return {'title': artigo['title'], 'abstract': artigo['abstract']} | judgement
+
+    if mode == 'single_pass':
+        feedback = get_judgement_json(artigo, query, model, max_tokens)
+    else:
+        prompt = f"Read the following article, named '{artigo['title']}', with the following content: \n {artigo['abstract']} \n \
+                Evaluate how relevant the article is to the following query: {query} \n"
+
+        response = get_initial_response(prompt, model, max_tokens)
+
+        feedback = get_feedback_json(artigo, query, response, model, max_tokens)
+
+    if store is not None:
+        store.put(query_id, get_doc_id(artigo), model, prompt_version, feedback['eval'], feedback['explanation'])
+    return {'title': artigo['title'], 'abstract': artigo['abstract'], 'eval': feedback['eval'], 'explanation': feedback['explanation']}
 
 def evaluate_articles_levels(artigos: list, 
                       query: str,
                       model: str = 'llama3-70b-8192',
                       max_tokens: int = 1000,
-                      verbose: bool = True):
+                      verbose: bool = True,
+                      max_workers: int = 4,
+                      store: JudgementStore | None = None,
+                      query_id: str | None = None,
+                      mode: str = 'two_step'):
     """
-    artigos: list of dictionaries with the following keys: 'title', 'abstract'
+    artigos: list of dictionaries with the following keys: 'title', 'abstract', and optionally 'id'
     query: string with the query that the articles will be evaluated against
     model: string with a valid model name from the GROQ API
     max_tokens: integer with the maximum number of tokens to be used in the completion
     verbose: boolean to print the evaluation process
+    max_workers: integer with the number of articles judged at the same time, the client's rate limits still apply
+    store: judgement store, only the articles without a judgement for this query, model and prompt are requested
+    query_id: id of the query in the judgement store, the query itself by default
+    mode: 'two_step' (initial response and feedback, two or more requests per article) or
+        'single_pass' (one JSON mode request per article), see evaluate_article_levels
 
     Returns a list of dictionaries with the following keys: 'title', 'abstract', 'eval', 'explanation',
     where 'eval' is an integer from 0 to 3 where 0 means no relevance, 1 is very slightly relevant,
-    2 is relevant, and 3 means completely relevant to the query, and 'explanation' is a string with the reasoning behind the evaluation    
+    2 is relevant, and 3 means completely relevant to the query, and 'explanation' is a string with the reasoning behind the evaluation,
+    in the order of the articles. Articles whose judgement failed (invalid after the retries, or an API error) are left out    
     """
 
-    evaluated = []
     if verbose: print("Query:", query)
 
-    for artigo in tqdm(artigos, desc="Evaluating articles"):
-        prompt = f"Read the following article, named '{artigo['title']}', with the following content: \n {artigo['abstract']} \n \
-                Evaluate how relevant the article is to the following query: {query} \n"
+    # Every worker runs both steps of one article, so the second call of an
+    # article overlaps with the first call of the next ones
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(evaluate_article_levels, artigo, query, model, max_tokens, store, query_id, mode): index
+            for index, artigo in enumerate(artigos)
+        }
+        results = {}
+        failures = 0
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Evaluating articles"):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                # A failed article does not throw away the judgements of the others
+                print("Error when evaluating article:", e)
+                failures += 1
+    evaluated = [results[index] for index in sorted(results)]
+    if failures:
+        print(f"{failures} of {len(artigos)} articles could not be evaluated")
 
-        response = get_initial_response(prompt, model, max_tokens)
+    if verbose:
+        for evaluation in evaluated:
+            print(f"Article: '{evaluation['title']}'\n Classification: {evaluation['eval']}, {evaluation['explanation']}")
+    return evaluated
 
-        feedback = get_feedback_json(artigo, query, response, model, max_tokens)
-        
-        if verbose: print(f"Article: '{artigo['title']}'\n Classification: {feedback}")
-        evaluated.append({'title': artigo['title'], 'abstract': artigo['abstract'], 'eval': feedback['eval'], 'explanation': feedback['explanation']})
+def load_checkpoint(checkpoint_path: str | Path, mode: str = 'two_step'):
+    """
+    checkpoint_path: path of the JSON lines file written by evaluate_queries_levels
+    mode: judging mode of the run, judgements given in another mode are left out
+
+    Returns a dictionary mapping (query, title) pairs to the judgements already stored in the checkpoint
+    """
+    checkpoint_path = Path(checkpoint_path)
+    judgements = {}
+    if not checkpoint_path.exists():
+        return judgements
+    with open(checkpoint_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                judgement = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be cut short by an interrupted run
+                continue
+            if judgement.pop('mode', 'two_step') != mode:
+                continue
+            judgements[(judgement['query'], judgement['title'])] = judgement
+    return judgements
+
+def evaluate_queries_levels(queries: list,
+                      checkpoint_path: str | Path = Path('data') / 'judgements_checkpoint.jsonl',
+                      model: str = 'llama3-70b-8192',
+                      max_tokens: int = 1000,
+                      max_workers: int = 4,
+                      store: JudgementStore | None = None,
+                      mode: str = 'two_step'):
+    """
+    queries: list of dictionaries with the keys 'query' and 'artigos', and optionally 'query_id',
+        where 'artigos' is a list of dictionaries with the keys 'title' and 'abstract', and optionally 'id'
+    checkpoint_path: path of a JSON lines file where every finished judgement is appended,
+        judgements already in it are not requested again, so an interrupted run resumes where it stopped
+    model: string with a valid model name from the GROQ API
+    max_tokens: integer with the maximum number of tokens to be used in the completion
+    max_workers: integer with the number of articles judged at the same time, the client's rate limits still apply
+    store: judgement store, pairs judged by earlier runs with the same model and prompt are not requested again
+    mode: 'two_step' or 'single_pass', see evaluate_article_levels
+
+    Returns a dictionary mapping every query to its list of evaluations, as returned by evaluate_articles_levels,
+    articles whose judgement failed (invalid after the retries, or an API error) are left out
+    """
+    checkpoint_path = Path(checkpoint_path)
+    checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+    judgements = load_checkpoint(checkpoint_path, mode)
+    if store is not None:
+        for query in queries:
+            stored = store.get_many(
+                query.get('query_id', query['query']),
+                [get_doc_id(artigo) for artigo in query['artigos']],
+                model,
+                get_levels_prompt_version(mode))
+            for artigo in query['artigos']:
+                if get_doc_id(artigo) in stored:
+                    judgements[(query['query'], artigo['title'])] = (
+                        {'query': query['query'], 'title': artigo['title'], 'abstract': artigo['abstract']}
+                        | stored[get_doc_id(artigo)])
+
+    pending = [
+        (query['query'], query.get('query_id', query['query']), artigo)
+        for query in queries
+        for artigo in query['artigos']
+        if (query['query'], artigo['title']) not in judgements
+    ]
+    print(f"{len(judgements)} judgements loaded from the checkpoint and the store, {len(pending)} to request")
+
+    start = monotonic()
+    with open(checkpoint_path, 'a', encoding='utf-8') as checkpoint, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(evaluate_article_levels, artigo, query, model, max_tokens, store, query_id, mode): query
+            for query, query_id, artigo in pending
+        }
+        progress = tqdm(as_completed(futures), total=len(futures), desc="Evaluating articles")
+        done = failures = 0
+        for future in progress:
+            try:
+                judgement = {'query': futures[future]} | future.result()
+            except Exception as e:
+                # Provider errors that outlive the retries included: the article is
+                # left out of the checkpoint, so the next run requests it again
+                print("Error when evaluating article:", e)
+                failures += 1
+                continue
+            # Results are collected on this thread only, one line per judgement
+            judgements[(judgement['query'], judgement['title'])] = judgement
+            checkpoint.write(json.dumps(judgement | {'mode': mode}, ensure_ascii=False) + '\n')
+            checkpoint.flush()
+            done += 1
+            progress.set_postfix(judgements_per_minute=f"{done / (monotonic() - start) * 60:.1f}", failures=failures)
+
+    elapsed = monotonic() - start
+    if pending:
+        print(f"{done} judgements in {elapsed:.0f}s ({done / elapsed * 60:.1f} judgements/minute), "
+              f"{failures} failures left for the next run")
+
+    return {
+        query['query']: [
+            {key: value for key, value in judgements[(query['query'], artigo['title'])].items() if key != 'query'}
+            for artigo in query['artigos']
+            if (query['query'], artigo['title']) in judgements
+        ]
+        for query in queries
+    }
+
+def build_listwise_batches(artigos: list,
+                      model: str = 'llama3-70b-8192',
+                      input_tokens: int = 3000,
+                      article_tokens: int = 400,
+                      max_batch_size: int = 10):
+    """
+    artigos: list of dictionaries with the keys 'title' and 'abstract'
+    model: string with the model name, used to count the tokens
+    input_tokens: integer with the maximum number of tokens of the articles sent in one request
+    article_tokens: integer with the maximum number of tokens of a single article, longer abstracts are truncated
+    max_batch_size: integer with the maximum number of articles sent in one request
+
+    Returns a list of batches, each a list of (index in artigos, article text) tuples
+    """
+    budget = PromptBudget(model, input_tokens=article_tokens)
+    batches, batch, batch_tokens = [], [], 0
+    for index, artigo in enumerate(artigos):
+        title, abstract = budget.pack(artigo['title'], artigo['abstract'])
+        text = f"Title: {title}\nContent: {abstract}\n"
+        tokens = budget.count(text)
+        if batch and (batch_tokens + tokens > input_tokens or len(batch) == max_batch_size):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append((index, text))
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def parse_listwise_judgements(judgements: str, ids: list):
+    """
+    judgements: string with the JSON object returned by the LLM
+    ids: list with the ids of the articles in the request
+
+    Checks that every id is graded exactly once, with an evaluation from 0 to 3
+
+    Returns a dictionary mapping every id to a dictionary with the keys 'explanation' and 'eval',
+    raises a ValueError when the judgements are not valid
+    """
+    try:
+        graded = json.loads(judgements)['judgements']
+        graded_ids = [str(judgement['id']) for judgement in graded]
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        raise ValueError(f"Invalid judgements: {judgements!r}") from e
+    if sorted(graded_ids) != sorted(ids):
+        raise ValueError(f"Expected one judgement for each of the ids {ids}, got {graded_ids}")
+    return {
+        str(judgement['id']): parse_judgement(json.dumps(judgement))
+        for judgement in graded
+    }
+
+def get_listwise_judgements(texts: list, query: str, model: str = 'llama3-70b-8192', article_max_tokens: int = 150, max_retries: int = 3):
+    """
+    texts: list with the article texts of one batch, as built by build_listwise_batches
+    query: string with the query that the articles will be evaluated against
+    model: string with a valid model name from the GROQ API
+    article_max_tokens: integer with the number of completion tokens allowed per article
+    max_retries: integer with the number of new requests after invalid judgements
+
+    Grades every article of the batch in a single JSON mode request, the rubric is sent once per batch
+
+    Returns a list with a dictionary with the keys 'explanation' and 'eval' for every text, in order,
+    raises a ValueError when every attempt returned invalid judgements
+    """
+    ids = [str(id) for id in range(1, len(texts) + 1)]
+    articles = "".join(f"Article id {id}:\n{text}\n" for id, text in zip(ids, texts))
+    refresh = False
+    for attempt in range(max_retries + 1):
+        judgements = create_completion(
+            messages=[
+                {"role": "system", "content": "You are an assistant AI specialized in evaluating articles based on a given query. \
+                    Your goal is to evaluate the relevance of each one of a list of articles based on a search query. The relevance levels are: \
+                    0 means that the article has absolutely no relevance for the query. \
+                    1 means that the article is only very slightly relevant to the query, sharing at most a similar topic. \
+                    2 means that the article is relevant to the query, sharing many similarities, but it's still not entirely relevant to the query. \
+                    3 means that the article is completely relevant to the query. \
+                    Evaluate every article on its own, try to avoid extreme answers like 0 or 3 unless you are sure that is the case. \
+                    Write your answer in the following json structure, with exactly one entry for each article id, where 'explanation' represents your reasoning, and 'eval' represents your evaluation: \n \
+                    {\"judgements\": [{\"id\": \"the article id\", \"explanation\": \"a one sentence explanation\", \"eval\": \"your evaluation, needs to be exactly 0, 1, 2, or 3.\"}]}"},
+                {"role": "user", "content": f"Read the following articles: \n {articles} \
+                    Evaluate how relevant each article is to the following query: {query} \n"}
+            ],
+            model=model,
+            max_tokens=article_max_tokens * len(texts) + 50,
+            refresh=refresh,
+            json_mode=True)
+        try:
+            parsed = parse_listwise_judgements(judgements.lower(), ids)
+            return [parsed[id] for id in ids]
+        except ValueError as e:
+            print(f"Error when parsing judgements (attempt {attempt + 1} of {max_retries + 1}):", e)
+            # Never retry against the same unparsable cached completion
+            refresh = True
+    raise ValueError(f"No valid judgements for a batch of {len(texts)} articles after {max_retries + 1} attempts")
+
+def evaluate_articles_listwise(artigos: list,
+                      query: str,
+                      model: str = 'llama3-70b-8192',
+                      verbose: bool = True,
+                      store: JudgementStore | None = None,
+                      query_id: str | None = None,
+                      input_tokens: int = 3000,
+                      max_batch_size: int = 10):
+    """
+    artigos: list of dictionaries with the following keys: 'title', 'abstract', and optionally 'id'
+    query: string with the query that the articles will be evaluated against
+    model: string with a valid model name from the GROQ API
+    verbose: boolean to print the evaluation process
+    store: judgement store, only the articles without a listwise judgement for this query and model are requested
+    query_id: id of the query in the judgement store, the query itself by default
+    input_tokens: integer with the maximum number of tokens of the articles sent in one request
+    max_batch_size: integer with the maximum number of articles sent in one request
+
+    Judges the articles in batches, so a top 10 takes one or two requests instead of twenty,
+    a batch that still fails after the retries is left out of the result
+
+    Returns a list of dictionaries with the same keys as evaluate_articles_levels
+    """
+    if verbose: print("Query:", query)
+
+    query_id = query if query_id is None else query_id
+    judged = {} if store is None else store.get_many(
+        query_id, [get_doc_id(artigo) for artigo in artigos], model, LISTWISE_PROMPT_VERSION)
+    missing = [artigo for artigo in artigos if get_doc_id(artigo) not in judged]
+
+    for batch in tqdm(build_listwise_batches(missing, model, input_tokens, max_batch_size=max_batch_size), desc="Evaluating batches"):
+        try:
+            judgements = get_listwise_judgements([text for _, text in batch], query, model)
+        except ValueError as e:
+            print("Error when evaluating batch:", e)
+            continue
+        for (index, _), judgement in zip(batch, judgements):
+            judged[get_doc_id(missing[index])] = judgement
+            if store is not None:
+                store.put(query_id, get_doc_id(missing[index]), model, LISTWISE_PROMPT_VERSION, judgement['eval'], judgement['explanation'])
+
+    evaluated = [
+        {'title': artigo['title'], 'abstract': artigo['abstract']} | judged[get_doc_id(artigo)]
+        for artigo in artigos
+        if get_doc_id(artigo) in judged
+    ]
+    if verbose:
+        for evaluation in evaluated:
+            print(f"Article: '{evaluation['title']}'\n Classification: {evaluation['eval']}, {evaluation['explanation']}")
     return evaluated
 
+def get_boolean_judgement(artigo: dict, query: str, model: str = 'llama3-70b-8192', max_tokens: int = 1000, max_retries: int = 3):
+    """
+    artigo: dictionary with the keys 'title' and 'abstract'
+    query: string with the query that the article will be evaluated against
+    model: string with a valid model name from the GROQ API
+    max_tokens: integer with the maximum number of tokens to be used in the completion
+    max_retries: integer with the number of new requests after a response other than 0 or 1
+
+    Returns the string '0' or '1', raises a ValueError when every attempt returned an invalid response
+    """
+    prompt = f"Read the following article, named '{artigo['title']}', with the following content: \n {artigo['abstract']} \n \
+                Evaluate if the article is relevant to the following query, and don't be strict about your classification: {query} \n"
+
+    refresh = False
+    for attempt in range(max_retries + 1):
+        response = create_completion(
+            messages=[
+                {"role": "user", "content": "You are an assistant AI specialized in evaluating articles based on a given query. \
+                        Your goal is to evaluate an article's relevance based on a search query. You should return only the number 1 or 0, where 1 means true and 0 means false, \
+                        based on whether the article is at least slightly relevant to a given query. If the article is related to the same field, it is enough for it to be considered relevant. For example: \n \
+                        Read the following article, named 'Increased lifespan on athletes', with the following content: \n Sports practicing has been shown to increase lifespawn and health. \n\
+                        Evaluate if the article is relevant to the following query: Positive health impacts on volleyball practice. \n \
+                        Response: 1"},
+                {"role": "user", "content": prompt}
+            ],
+            model=model,
+            max_tokens=max_tokens,
+            refresh=refresh)
+        if response.strip() in ['0', '1']:
+            return response.strip()
+        print(f"Invalid response (attempt {attempt + 1} of {max_retries + 1}): {response!r}")
+        # Never retry against the same invalid cached completion
+        refresh = True
+    raise ValueError(f"No valid boolean judgement for the article '{artigo['title']}' after {max_retries + 1} attempts")
+
 def evaluate_articles_boolean(artigos: list, 
                       query: str,
                       model: str = 'llama3-70b-8192',
                       max_tokens: int = 1000,
-                      verbose: bool = True):
+                      verbose: bool = True,
+                      store: JudgementStore | None = None,
+                      query_id: str | None = None,
+                      max_retries: int = 3):
     """
-    artigos: list of dictionaries with the following keys: 'title', 'abstract'
+    artigos: list of dictionaries with the following keys: 'title', 'abstract', and optionally 'id'
     query: string with the query that the articles will be evaluated against
     model: string with a valid model name from the GROQ API
     max_tokens: integer with the maximum number of tokens to be used in the completion
     verbose: boolean to print the evaluation process
+    store: judgement store, only the articles without a judgement for this query, model and prompt are requested
+    query_id: id of the query in the judgement store, the query itself by default
+    max_retries: integer with the number of new requests after an invalid response, an article still
+        without a valid judgement after them is left out of the result
 
     Returns a list of dictionaries with the following keys: 'title', 'abstract', 'eval', where 'eval' is a boolean value where 1 means relevant and 0 means not relevant to the query    
     """
@@ -153,33 +631,22 @@ def evaluate_articles_boolean(artigos: list,
     evaluated = []
     if verbose: print("Query:", query)
 
+    query_id = query if query_id is None else query_id
+    stored = {} if store is None else store.get_many(
+        query_id, [get_doc_id(artigo) for artigo in artigos], model, BOOLEAN_PROMPT_VERSION)
+
     for artigo in tqdm(artigos, desc="Evaluating articles"):
-        prompt = f"Read the following article, named '{artigo['title']}', with the following content: \n {artigo['abstract']} \n \
-                Evaluate if the article is relevant to the following query, and don't be strict about your classification: {query} \n"
+        if get_doc_id(artigo) in stored:
+            evaluated.append({'title': artigo['title'], 'abstract': artigo['abstract'], 'eval': str(stored[get_doc_id(artigo)]['eval'])})
+            continue
 
-        while True:
-            try:
-                response = client.chat.completions.create(
-                    model=model,
-                    n=1,
-                    messages=[
-                        {"role": "user", "content": "You are an assistant AI specialized in evaluating articles based on a given query. \
-                        Your goal is to evaluate an article's relevance based on a search query. You should return only the number 1 or 0, where 1 means true and 0 means false, \
-                        based on whether the article is at least slightly relevant to a given query. If the article is related to the same field, it is enough for it to be considered relevant. For example: \n \
-                        Read the following article, named 'Increased lifespan on athletes', with the following content: \n Sports practicing has been shown to increase lifespawn and health. \n\
-                        Evaluate if the article is relevant to the following query: Positive health impacts on volleyball practice. \n \
-                        Response: 1"},
-                        {"role": "user", "content": prompt}
-                    ],
-                    max_tokens = max_tokens)
-                if int(response.choices[0].message.content.lower()) in [0, 1]:
-                    evaluated.append({'title': artigo['title'], 'abstract': artigo['abstract'], 'eval': response.choices[0].message.content.lower()})
-                    if verbose: print(f"Article '{artigo['title']}' evaluated as {response.choices[0].message.content.lower()}")
-                    break
-                else:
-                    print("Invalid response, trying again.")
-            except Exception as e:
-                print("Rate limit achieved:", e)
-                sleep(30)
-                continue
-    return evaluated
\ No newline at end of file
+        try:
+            response = get_boolean_judgement(artigo, query, model, max_tokens, max_retries)
+        except ValueError as e:
+            print("Error when evaluating article:", e)
+            continue
+        evaluated.append({'title': artigo['title'], 'abstract': artigo['abstract'], 'eval': response})
+        if store is not None:
+            store.put(query_id, get_doc_id(artigo), model, BOOLEAN_PROMPT_VERSION, int(response))
+        if verbose: print(f"Article '{artigo['title']}' evaluated as {response}")
+    return evaluated
@@ -0,0 +1,222 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from time import monotonic
+from tqdm import tqdm
+import json
+import random
+import re
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'how', 'in', 'is', 'it',
+    'of', 'on', 'or', 'that', 'the', 'to', 'what', 'which', 'with'
+}
+
+def sample_articles(path: str | Path, n: int, seed: int | None = None):
+    """
+    path: path of a JSON lines file with one article per line
+    n: integer with the number of articles to sample
+    seed: seed of the random generator, so the sample is reproducible
+
+    Reads the file once, line by line (reservoir sampling), so the whole arXiv snapshot never has to fit in memory
+
+    Returns a list with n articles sampled uniformly, or every article when the file has fewer
+    """
+    rng = random.Random(seed)
+    sample = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            if i < n:
+                sample.append(line)
+            else:
+                j = rng.randint(0, i)
+                if j < n:
+                    sample[j] = line
+    return [json.loads(line) for line in sample]
+
+def generate_query(artigo: dict, client, model: str = 'llama3-70b-8192', max_tokens: int = 1000):
+    """
+    artigo: dictionary with the keys 'title' and 'abstract'
+    client: RateLimitedClient around a GROQ or OpenAI client
+    model: string with a valid model name from the GROQ API
+    max_tokens: integer with the maximum number of tokens to be used in the completion
+
+    Returns a string with the search query generated for the article, without quotes
+    """
+    prompt = f"Read the following article, named '{artigo['title']}', and create a search query based on its content. \
+        The article's content is as follows: \n {artigo['abstract']}."
+
+    response = client.create(
+        model=model,
+        n=1,
+        messages=[
+            {"role": "system", "content": "You are an assistant AI specialized in creating search queries based on the content of articles. \
+                     Your goal is to generate a search query that would be able to find the article you just read. Remember to be concise and clear in your query. \
+                     The query should be made as if it were written by a human user, using natural language, and can't be a direct copy of something written in the text. \
+                     You should return only the query, without any additional information."},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens = max_tokens)
+
+    query = response.choices[0].message.content.lower()
+    return query.replace('"', '').replace("'", "").strip()
+
+def query_tokens(query: str):
+    """
+    query: string with a search query
+
+    Returns the set of words of the query, lowercased, without punctuation and stopwords
+    """
+    return {token for token in re.findall(r'\w+', query.lower()) if token not in STOPWORDS}
+
+class QueryDeduplicator:
+    """
+    Detects near-identical queries by the Jaccard similarity of their word sets
+
+    An inverted index from words to queries limits the comparisons to queries that share a word,
+    so checking a new query does not compare it with the whole set
+    """
+
+    def __init__(self, threshold: float = 0.8) -> None:
+        """
+        threshold: float with the Jaccard similarity from which two queries are considered duplicates
+        """
+        self.threshold = threshold
+        self.queries = []
+        self.index = {}
+
+    def is_duplicate(self, query: str):
+        """
+        query: string with a search query
+
+        Returns True when a query already added is near-identical to this one
+        """
+        tokens = query_tokens(query)
+        if not tokens:
+            return True
+        candidates = set()
+        for token in tokens:
+            candidates.update(self.index.get(token, ()))
+        for candidate in candidates:
+            other = self.queries[candidate]
+            if len(tokens & other) / len(tokens | other) >= self.threshold:
+                return True
+        return False
+
+    def add(self, query: str) -> None:
+        """
+        query: string with a search query to compare the next ones against
+        """
+        tokens = query_tokens(query)
+        for token in tokens:
+            self.index.setdefault(token, []).append(len(self.queries))
+        self.queries.append(tokens)
+
+def load_generated(output_path: str | Path):
+    """
+    output_path: path of the JSON lines file written by generate_queries
+
+    Returns a list with the articles and their queries already in the file
+    """
+    output_path = Path(output_path)
+    if not output_path.exists():
+        return []
+    generated = []
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                generated.append(json.loads(line))
+            except json.JSONDecodeError:
+                # The last line may be cut short by an interrupted run
+                continue
+    return generated
+
+def get_dropped_path(output_path: str | Path):
+    """
+    output_path: path of the JSON lines file written by generate_queries
+
+    Returns the path of the file where generate_queries records the dropped articles, next to the output file,
+    so the output keeps one article with its query per line
+    """
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}.dropped{output_path.suffix}")
+
+def load_dropped(output_path: str | Path):
+    """
+    output_path: path of the JSON lines file written by generate_queries
+
+    Returns the set of ids of the articles whose query was dropped as a near-duplicate
+    """
+    return {str(row['id']) for row in load_generated(get_dropped_path(output_path))}
+
+def generate_queries(artigos: list,
+                     client,
+                     output_path: str | Path = Path('data') / 'queries.json',
+                     model: str = 'llama3-70b-8192',
+                     max_tokens: int = 1000,
+                     max_workers: int = 4,
+                     threshold: float = 0.8):
+    """
+    artigos: list of dictionaries with the keys 'id', 'title' and 'abstract'
+    client: RateLimitedClient around a GROQ or OpenAI client, its limits bound the request rate
+    output_path: path of the JSON lines file where every article is appended with its 'query'
+    model: string with a valid model name from the GROQ API
+    max_tokens: integer with the maximum number of tokens to be used in the completion
+    max_workers: integer with the number of queries generated at the same time
+    threshold: float with the Jaccard similarity from which a query is dropped as a duplicate of an earlier one
+
+    Articles already in the output file are skipped, so an interrupted run resumes where it stopped.
+    Articles whose query is a near-duplicate are recorded in the file given by get_dropped_path and
+    skipped by later runs too, articles whose generation failed are not recorded and are requested again
+
+    Returns a list with every article and its query in the output file
+    """
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    generated = load_generated(output_path)
+    done = {str(artigo['id']) for artigo in generated} | load_dropped(output_path)
+
+    deduplicator = QueryDeduplicator(threshold)
+    for artigo in generated:
+        deduplicator.add(artigo['query'])
+
+    pending = [artigo for artigo in artigos if str(artigo['id']) not in done]
+    print(f"{len(generated)} queries loaded from {output_path}, {len(done) - len(generated)} dropped, "
+          f"{len(pending)} to generate")
+
+    duplicates = failures = 0
+    start = monotonic()
+    with open(output_path, 'a', encoding='utf-8') as output, \
+            open(get_dropped_path(output_path), 'a', encoding='utf-8') as dropped, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(generate_query, artigo, client, model, max_tokens): artigo
+            for artigo in pending
+        }
+        progress = tqdm(as_completed(futures), total=len(futures), desc="Generating queries for articles")
+        for future in progress:
+            artigo = futures[future]
+            try:
+                query = future.result()
+            except Exception as e:
+                print(f"Error when generating a query for '{artigo['title']}':", e)
+                failures += 1
+                continue
+            # Deduplication and writes happen on this thread only
+            if deduplicator.is_duplicate(query):
+                # Recorded, so a resumed run does not pay for this article again
+                dropped.write(json.dumps({'id': artigo['id'], 'dropped': 'duplicate', 'query': query}) + '\n')
+                dropped.flush()
+                duplicates += 1
+                continue
+            deduplicator.add(query)
+            artigo = artigo | {'query': query}
+            output.write(json.dumps(artigo) + '\n')
+            output.flush()
+            generated.append(artigo)
+            progress.set_postfix(duplicates=duplicates, failures=failures)
+
+    if pending:
+        elapsed = monotonic() - start
+        print(f"{len(pending)} articles in {elapsed:.0f}s ({len(pending) / elapsed * 60:.1f} articles/minute), "
+              f"{duplicates} duplicates and {failures} failures dropped")
+    return generated
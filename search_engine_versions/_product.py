@@ -0,0 +1,25 @@
+"""Adapter running the app's SearchEngineLocal as a variant of experiment_runner"""
+
+from pathlib import Path
+
+from ArticLE.search.search_engine import SearchEngineLocal
+
+
+class ProductSearchEngine(SearchEngineLocal):
+    # Every variant gets its own container and manifest, so switching the
+    # layout never reuses documents fed with the other one
+    package_name = "hybridsearch"
+    binary_quantization = False
+
+    def __init__(self, data_dir=Path("data")):
+        super().__init__(
+            data_dir,
+            [],
+            manifest_path=Path(data_dir) / f"{self.package_name}_manifest.json",
+            binary_quantization=self.binary_quantization,
+            feed=False,
+        )
+
+    def set_package(self):
+        super().set_package()
+        self.package.name = self.package_name
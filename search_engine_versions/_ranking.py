@@ -0,0 +1,92 @@
+from vespa.package import (
+    FirstPhaseRanking, Function, MatchPhaseRanking, RankProfile, SecondPhaseRanking
+)
+
+COLBERT_INPUTS = [
+    ("query(q)", "tensor<float>(x[384])"),
+    ("query(qt)", "tensor<float>(querytoken{}, v[128])"),
+]
+
+
+def colbert_rank_profiles(
+    rerank_count: int = 100,
+    num_threads_per_search: int | None = None,
+    match_phase: MatchPhaseRanking | None = None,
+    debug: bool = False
+) -> list[RankProfile]:
+    # MaxSim is only evaluated for the rerank_count best cos_sim hits per content
+    # node, and the per-body tensors are only returned when debugging
+    limits = {}
+    if num_threads_per_search is not None:
+        limits["num_threads_per_search"] = num_threads_per_search
+    if match_phase is not None:
+        limits["match_phase"] = match_phase
+
+    return [
+        RankProfile(
+            name="colbert_local",
+            inputs=COLBERT_INPUTS,
+            functions=[
+                Function(name="cos_sim", expression="closeness(field, embedding)"),
+                Function(
+                    name="max_sim_per_body",
+                    expression="""
+                        sum(
+                            reduce(
+                                sum(
+                                    query(qt) * unpack_bits(attribute(colbert)) , v
+                                ),
+                                max, token
+                            ),
+                            querytoken
+                        )
+                    """,
+                ),
+                Function(
+                    name="max_sim_local", expression="reduce(max_sim_per_body, max, body)"
+                ),
+            ],
+            first_phase=FirstPhaseRanking(expression="cos_sim"),
+            second_phase=SecondPhaseRanking(
+                expression="max_sim_local", rerank_count=rerank_count
+            ),
+            match_features=(
+                ["cos_sim", "max_sim_local", "max_sim_per_body"] if debug
+                else ["cos_sim", "max_sim_local"]
+            ),
+            **limits
+        ),
+        RankProfile(
+            name="colbert_global",
+            inputs=COLBERT_INPUTS,
+            functions=[
+                Function(name="cos_sim", expression="closeness(field, embedding)"),
+                Function(
+                    name="max_sim_cross_body",
+                    expression="""
+                    sum(
+                        reduce(
+                            sum(
+                                query(qt) *  unpack_bits(attribute(colbert)) , v
+                            ),
+                            max, token, body
+                        ),
+                        querytoken
+                    )
+                    """
+                ),
+                Function(
+                    name="max_sim_global", expression="reduce(max_sim_cross_body, max)"
+                ),
+            ],
+            first_phase=FirstPhaseRanking(expression="cos_sim"),
+            second_phase=SecondPhaseRanking(
+                expression="max_sim_global", rerank_count=rerank_count
+            ),
+            match_features=(
+                ["cos_sim", "max_sim_global", "max_sim_cross_body"] if debug
+                else ["cos_sim", "max_sim_global"]
+            ),
+            **limits
+        ),
+    ]
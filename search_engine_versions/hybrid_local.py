@@ -0,0 +1,8 @@
+"""Search Engine of the app (SearchEngineLocal) using Hybrid Search ranking with full precision embeddings"""
+
+from search_engine_versions._product import ProductSearchEngine
+
+
+class SearchEngine(ProductSearchEngine):
+    package_name = "hybridlocal"
+    binary_quantization = False
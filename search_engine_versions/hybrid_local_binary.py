@@ -0,0 +1,8 @@
+"""Search Engine of the app (SearchEngineLocal) using Hybrid Search ranking with binary quantized embeddings, reranked in full precision"""
+
+from search_engine_versions._product import ProductSearchEngine
+
+
+class SearchEngine(ProductSearchEngine):
+    package_name = "hybridlocalbinary"
+    binary_quantization = True
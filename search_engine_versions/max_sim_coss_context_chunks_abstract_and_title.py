@@ -9,6 +9,8 @@ from vespa.deployment import VespaDocker
 from datasets import load_dataset
 from vespa.io import VespaResponse, VespaQueryResponse
 
+from search_engine_versions._ranking import colbert_rank_profiles
+
 def chunk_split(string, chunk_size=1024, chunk_overlap=0):
     chunks = []
     for i in range(0, len(string), chunk_size - chunk_overlap):
@@ -37,7 +39,13 @@ def flatten_to_string(data):
     return ', '.join(f"{k}: {v}" for k, v in flattened_items)
 
 class SearchEngine:
-    def __init__(self):
+    def __init__(self, mode="streaming", **ranking_options):
+        # "index" builds a multi-vector HNSW over the chunk embeddings, "streaming"
+        # brute-forces each group and suits per-user collections
+        self.mode = mode
+        # Forwarded to colbert_rank_profiles: rerank_count, num_threads_per_search,
+        # match_phase and debug
+        self.ranking_options = ranking_options
         self.set_package()
         self.set_docker()
         self.set_app()
@@ -48,7 +56,7 @@ class SearchEngine:
             schema=[
                 Schema(
                     name="doc",
-                    mode="streaming",
+                    mode=self.mode,
                     document=Document(
                         fields=[
                             Field(name="id", type="string", indexing=["summary"]),
@@ -63,8 +71,9 @@ class SearchEngine:
                                     'for_each { (input title || "") . " " . ( _ || "") }',
                                     "embed e5",
                                     "attribute",
-                                ],
-                                attribute=["distance-metric: angular"],
+                                ] + (["index"] if self.mode == "index" else []),
+                                attribute=None if self.mode == "index" else ["distance-metric: angular"],
+                                ann=HNSW(distance_metric="angular") if self.mode == "index" else None,
                                 is_document_field=False,
                             ),
                             Field(
@@ -75,68 +84,7 @@ class SearchEngine:
                             ),
                         ]
                     ),
-                    rank_profiles=[
-                        RankProfile(
-                            name="colbert_local",
-                            inputs=[
-                                ("query(q)", "tensor<float>(x[384])"),
-                                ("query(qt)", "tensor<float>(querytoken{}, v[128])"),
-                            ],
-                            functions=[
-                                Function(name="cos_sim", expression="closeness(field, embedding)"),
-                                Function(
-                                    name="max_sim_per_body",
-                                    expression="""
-                                        sum(
-                                            reduce(
-                                                sum(
-                                                    query(qt) * unpack_bits(attribute(colbert)) , v
-                                                ),
-                                                max, token
-                                            ),
-                                            querytoken
-                                        )
-                                    """,
-                                ),
-                                Function(
-                                    name="max_sim_local", expression="reduce(max_sim_per_body, max, body)"
-                                ),
-                            ],
-                            first_phase=FirstPhaseRanking(expression="cos_sim"),
-                            second_phase=SecondPhaseRanking(expression="max_sim_local"),
-                            match_features=["cos_sim", "max_sim_local", "max_sim_per_body"],
-                        ),
-                        RankProfile(
-                            name="colbert_global",
-                            inputs=[
-                                ("query(q)", "tensor<float>(x[384])"),
-                                ("query(qt)", "tensor<float>(querytoken{}, v[128])"),
-                            ],
-                            functions=[
-                                Function(name="cos_sim", expression="closeness(field, embedding)"),
-                                Function(
-                                    name="max_sim_cross_body",
-                                    expression="""
-                                    sum(
-                                        reduce(
-                                            sum(
-                                                query(qt) *  unpack_bits(attribute(colbert)) , v
-                                            ),
-                                            max, token, body
-                                        ),
-                                        querytoken
-                                    )
-                                    """
-                                ),
-                                Function(
-                                    name="max_sim_global", expression="reduce(max_sim_cross_body, max)"
-                                ),
-                            ],
-                            first_phase=FirstPhaseRanking(expression="cos_sim"),
-                            second_phase=SecondPhaseRanking(expression="max_sim_global"),
-                            match_features=["cos_sim", "max_sim_global", "max_sim_cross_body"],
-                        )
-                    ]
+                    rank_profiles=colbert_rank_profiles(**self.ranking_options)
                 )
             ],
             components=[
@@ -204,7 +152,7 @@ class SearchEngine:
         if not response.is_successful():
             print(f"Error when feeding document {id}: {response.get_json()}")
 
-    def feed_json(self, data_dir, data_files, split_size_limit):
+    def feed_json(self, data_dir, data_files, split_size_limit, groupname="article-groupname"):
         dataset = load_dataset(
             "json",
             data_dir=data_dir,
@@ -229,7 +177,10 @@ class SearchEngine:
         
         def vespa_feed():
             for doc in docs:
-                yield {"fields": doc, "id": doc["id"], "groupname": "article-groupname"}
+                if self.mode == "streaming":
+                    yield {"fields": doc, "id": doc["id"], "groupname": groupname}
+                else:
+                    yield {"fields": doc, "id": doc["id"]}
 
         self.app.feed_iterable(iter=vespa_feed(), schema="doc", namespace="article", callback=self.callback)
 
@@ -247,17 +198,17 @@ class SearchEngine:
             records.append(record)
         return pd.DataFrame(records)
 
-    def search(self, query, n_hits: int = 5):
+    def search(self, query, n_hits: int = 5, groupname="article-groupname"):
         with self.app.syncio(connections=1) as session:
             response:VespaQueryResponse = session.query(
                 yql="select * from sources * where ({targetHits:1000}nearestNeighbor(embedding,q))",
-                groupname="article-groupname",
                 ranking="colbert_global",
                 query=query,
                 body={
                     "input.query(q)": f'embed(e5, "{query}")',
                     "input.query(qt)": f'embed(colbert, "{query}")',
                 },
+                **({"groupname": groupname} if self.mode == "streaming" else {}),
             )
         assert(response.is_successful())
         return self.hits_to_df(response)
\ No newline at end of file
@@ -22,14 +22,31 @@ class SaveMetrics():
     range : str
         Range do sheet onde os dados serão salvos. O padrão é 'A:AZ'. Utiliza 
         a sintaxe do Google Sheets para definir o range. Exemplo: 'A:AZ' ou 'A1:AZ100'
+    buffered : bool
+        Se True, as métricas são acumuladas localmente e só são enviadas ao
+        Google Sheets em `flush` (ou ao sair do bloco `with`). O padrão é False,
+        que envia cada chamada imediatamente
     '''
-    def __init__(self, range:str='A:AZ') -> None:
+    def __init__(self, range:str='A:AZ', buffered:bool=False) -> None:
         self.range = range
+        self.buffered = buffered
         self.sheet = build(
             'sheets', 
             'v4', 
             credentials=self._set_creds()
         ).spreadsheets()
+        # Cabeçalho e índice das queries de cada página, lidos uma única vez
+        self._headers = {}
+        self._query_rows = {}
+        # Escritas pendentes: linhas por página e células individuais
+        self._pending_rows = {}
+        self._pending_cells = {}
+
+    def __enter__(self) -> 'SaveMetrics':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
 
     def _set_creds(self) -> Credentials:
         '''
@@ -45,9 +62,51 @@ class SaveMetrics():
             'client_secret.json', scopes=SCOPES)
         return creds
 
+    def _load_layout(self, type_of_metric:str) -> None:
+        '''
+        Função para ler o cabeçalho (primeira linha) e a coluna de queries
+        (primeira coluna) de uma página em uma única requisição, guardando
+        ambos em cache
+
+        Parâmetros
+        ----------
+        type_of_metric : str
+            Tipo de métrica (página do Google Sheets)
+        '''
+        if type_of_metric in self._headers:
+            return
+        first_row_range = ":".join([re.sub(r'\d+', '', col) + "1" for col in self.range.split(':')])
+        result = self.sheet.values().batchGet(
+            spreadsheetId=SPREADSHEET_ID,
+            ranges=[f"{type_of_metric}!{first_row_range}", f"{type_of_metric}!A:A"]
+        ).execute()
+        first_row, first_column = [r.get('values', []) for r in result.get('valueRanges', [{}, {}])]
+        self._headers[type_of_metric] = first_row[0] if first_row else []
+        self._query_rows[type_of_metric] = {
+            l[0]: row for row, l in enumerate(first_column, start=1) if l
+        }
+
+    def invalidate_cache(self, type_of_metric:str | None = None) -> None:
+        '''
+        Função para descartar o cabeçalho e o índice de queries em cache,
+        necessária quando outra pessoa altera o layout da página
+
+        Parâmetros
+        ----------
+        type_of_metric : str | None
+            Página a ser descartada. Se None, descarta todas
+        '''
+        if type_of_metric is None:
+            self._headers.clear()
+            self._query_rows.clear()
+        else:
+            self._headers.pop(type_of_metric, None)
+            self._query_rows.pop(type_of_metric, None)
+
     def append_metrics(self, type_of_metric:str, data:pd.DataFrame) -> None:
         '''
-        Função para adicionar uma linha de dados no Google Sheets
+        Função para adicionar linhas de dados no Google Sheets. As linhas são
+        anexadas ao final da página com `values().append`, sem reler o sheet
 
         Parâmetros
         ----------
@@ -60,37 +119,24 @@ class SaveMetrics():
         ----------
         None
         '''
-        # Define a página e o range
-        range = f"{type_of_metric}!{self.range}"
-
-        # Pega os valores atuais do sheet
-        result = self.sheet.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=range
-        ).execute()
-        values = result.get('values', [])
+        self._load_layout(type_of_metric)
+        header = self._headers[type_of_metric]
+        pending = self._pending_rows.setdefault(type_of_metric, [])
 
-        if len(values) > 0:
-            # Ordena o dataframe pelas colunas do sheet
-            data = data.sort_values(by=values[0], axis=0)
-            # Converte o dataframe em uma lista de listas
-            data = data.values.tolist()
+        if len(header) > 0:
+            # Ordena as colunas do dataframe pelas colunas do sheet
+            data = data[header]
         else:
-            # Adiciona o cabeçalho ao sheet
-            values = [data.columns.tolist()]
-            # Converte o dataframe em uma lista de listas
-            data = data.values.tolist()
+            # Adiciona o cabeçalho ao sheet, junto com as primeiras linhas
+            header = data.columns.tolist()
+            self._headers[type_of_metric] = header
+            pending.append(header)
 
-        # Adiciona os valores ao sheet
-        values += data
+        # Converte o dataframe em uma lista de listas
+        pending += data.values.tolist()
 
-        # Atualiza o sheet
-        result = self.sheet.values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range=range, 
-            valueInputOption="RAW",
-            body={"values": values}
-        ).execute()
+        if not self.buffered:
+            self.flush()
 
     def set_metric_of_query_and_model(
             self, 
@@ -103,7 +149,8 @@ class SaveMetrics():
         Função para salvar o resultado da métrica de uma query e modelo no Google Sheets.
         Esse método depende da tabela estar preparada com o id das queries na
         primeira coluna (A2 em diante) e o nome dos modelos na 
-        primeira linha (B2 em diante).
+        primeira linha (B2 em diante). O cabeçalho e as queries ficam em cache,
+        então só a escrita da célula vai ao Google Sheets (ou ao buffer)
 
         Parâmetros
         ----------
@@ -121,38 +168,85 @@ class SaveMetrics():
         range : str
             Localização do resultado no Google Sheets
         '''
-        # Pega os valores atuais da primeira linha do sheet
-        first_row = self.sheet.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=":".join([re.sub(r'\d+', '', col) + "1" for col in self.range.split(':')])
-        ).execute()
-        models = first_row.get('values', [])[0]
-        
-        # Pega os valores atuais da primeira coluna do sheet
-        first_column = self.sheet.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{type_of_metric}!A:A"
-        ).execute()
-        queries = [l[0] for l in first_column.get('values', [])]
+        self._load_layout(type_of_metric)
 
         # Obtém a posição da célula referente à query e ao modelo
-        row = queries.index(query) + 1
-        col = models.index(model_name) + 1
+        row = self._query_rows[type_of_metric][query]
+        col = self._headers[type_of_metric].index(model_name) + 1
         
         # Define a página e o range
         range = f"{type_of_metric}!{convert_number_to_column_name(col)}{row}"
 
-        # Atualiza o sheet
-        self.sheet.values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range=range,
-            valueInputOption="RAW",
-            body={"values": [[result]]}
-        ).execute()
+        # A última escrita de uma mesma célula prevalece
+        self._pending_cells[range] = result
+
+        if not self.buffered:
+            self.flush()
 
         # Retorna a localização do resultado
         return range
 
+    def flush(self) -> None:
+        '''
+        Função para enviar as escritas pendentes ao Google Sheets: todas as
+        células em um único `values().batchUpdate` e as linhas de cada página
+        em um `values().append`
+        '''
+        if self._pending_cells:
+            self.sheet.values().batchUpdate(
+                spreadsheetId=SPREADSHEET_ID,
+                body={
+                    "valueInputOption": "RAW",
+                    "data": [
+                        {"range": range, "values": [[result]]}
+                        for range, result in self._pending_cells.items()
+                    ]
+                }
+            ).execute()
+            self._pending_cells = {}
+
+        for type_of_metric, rows in self._pending_rows.items():
+            if not rows:
+                continue
+            response = self.sheet.values().append(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"{type_of_metric}!{self.range}",
+                valueInputOption="RAW",
+                insertDataOption="INSERT_ROWS",
+                body={"values": rows}
+            ).execute()
+            self._cache_appended_rows(type_of_metric, response, rows)
+        self._pending_rows = {}
+
+    def _cache_appended_rows(self, type_of_metric:str, response:dict, rows:list) -> None:
+        '''
+        Função para adicionar as queries das linhas anexadas ao índice de
+        queries em cache, a partir da linha inicial informada pelo Google
+        Sheets. Sem ela, uma query anexada por este objeto não seria
+        encontrada por `set_metric_of_query_and_model`
+
+        Parâmetros
+        ----------
+        type_of_metric : str
+            Página onde as linhas foram anexadas
+        response : dict
+            Resposta do `values().append`
+        rows : list
+            Linhas anexadas
+        '''
+        query_rows = self._query_rows.get(type_of_metric)
+        if query_rows is None:
+            return
+        updated_range = response.get('updates', {}).get('updatedRange', '')
+        match = re.search(r'!\D*(\d+)', updated_range)
+        if match is None:
+            # Sem a linha inicial, o índice é relido na próxima consulta
+            self.invalidate_cache(type_of_metric)
+            return
+        for row, values in enumerate(rows, start=int(match.group(1))):
+            if values and values[0] not in ('', None):
+                query_rows[str(values[0])] = row
+
 def convert_number_to_column_name(number):
         '''
         Função para converter um número em uma coluna do Google Sheets (Notação A1).
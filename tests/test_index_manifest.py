@@ -0,0 +1,87 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from ArticLE.search.manifest import IndexManifest
+from ArticLE.search.search_engine import SearchEngineLocal
+
+DATA_FILES = ["articles.json"]
+
+
+class FakeApp:
+    def __init__(self, failing: set[str] | None = None) -> None:
+        self.failing = failing or set()
+        self.fed = []
+
+    def feed_iterable(self, iter, schema, namespace, callback):
+        for document in iter:
+            self.fed.append(document["id"])
+            ok = document["id"] not in self.failing
+            callback(SimpleNamespace(is_successful=lambda: ok, get_json=lambda: {}), document["id"])
+
+
+class OfflineSearchEngine(SearchEngineLocal):
+    # Feeds into a FakeApp instead of deploying a Vespa container
+    def __init__(self, *args, app: FakeApp, **kwargs) -> None:
+        self._fake_app = app
+        super().__init__(*args, **kwargs)
+
+    def set_app(self) -> None:
+        self.app = self._fake_app
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    with open(tmp_path / DATA_FILES[0], "w", encoding="utf-8") as f:
+        for i in range(5):
+            f.write(json.dumps({"id": str(i), "title": f"Title {i}", "abstract": f"Abstract {i}"}) + "\n")
+    return tmp_path
+
+
+def feed(data_dir, max_data_samples=None, failing=None) -> FakeApp:
+    app = FakeApp(failing)
+    OfflineSearchEngine(
+        data_dir, DATA_FILES, max_data_samples, app=app, cache_dir=str(data_dir / "cache")
+    )
+    return app
+
+
+def test_manifest_round_trip_and_merge(tmp_path):
+    manifest = IndexManifest("v1")
+    assert manifest.is_empty
+    manifest.append(DATA_FILES, 0, 3)
+    manifest.append(DATA_FILES, 3, 5)
+    manifest.append(DATA_FILES, 0, 2, collection="user-1")
+    manifest.save(tmp_path / "manifest.json")
+
+    loaded = IndexManifest.load(tmp_path / "manifest.json", "v1")
+    assert len(loaded.segments) == 2
+    assert loaded.fed_until(DATA_FILES) == 5
+    assert loaded.fed_until(DATA_FILES, "user-1") == 2
+    assert loaded.fed_until(["other.json"]) == 0
+    assert loaded.generation == 3
+
+
+def test_manifest_schema_change_starts_new_generation(tmp_path):
+    manifest = IndexManifest("v1")
+    manifest.append(DATA_FILES, 0, 5)
+    manifest.save(tmp_path / "manifest.json")
+
+    loaded = IndexManifest.load(tmp_path / "manifest.json", "v2")
+    assert loaded.is_empty
+    assert loaded.generation == manifest.generation + 1
+
+
+def test_resume_feeds_only_new_rows(data_dir):
+    assert feed(data_dir, max_data_samples=3).fed == ["0", "1", "2"]
+    assert feed(data_dir).fed == ["3", "4"]
+    # Nothing left to feed, with and without a limit past the end of the corpus
+    assert feed(data_dir).fed == []
+    assert feed(data_dir, max_data_samples=100).fed == []
+
+
+def test_failed_documents_are_fed_again(data_dir):
+    assert feed(data_dir, failing={"1"}).fed == ["0", "1", "2", "3", "4"]
+    assert feed(data_dir).fed == ["0", "1", "2", "3", "4"]
+    assert feed(data_dir).fed == []